@@ -0,0 +1,44 @@
+"""indexes for hot query predicates
+
+Revision ID: 3f8a6c2e7b15
+Revises: 9c14f0e6a2d8
+Create Date: 2026-10-18 14:05:52.913470
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f8a6c2e7b15'
+down_revision: Union[str, None] = '9c14f0e6a2d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+INDEXES = [
+    ('ix_users_sub', 'users', ['sub']),
+    ('ix_uploads_owner_id_created_at_id', 'uploads', ['owner_id', 'created_at', 'id']),
+    ('ix_uploads_created_at', 'uploads', ['created_at']),
+    ('ix_uploads_blob_digest', 'uploads', ['blob_digest']),
+    ('ix_shared_uploads_upload_id', 'shared_uploads', ['upload_id']),
+    ('ix_shared_recipients_recipient_email_shared_upload_id', 'shared_recipients', ['recipient_email', 'shared_upload_id']),
+    ('ix_history_user_email_created_at', 'history', ['user_email', 'created_at']),
+]
+
+
+def upgrade() -> None:
+    # Build the indexes without locking the tables against writes
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,44 @@
+"""atomic quota reservations
+
+Revision ID: 7a3d5f9e1c42
+Revises: d2e9b4a71f06
+Create Date: 2026-10-18 16:05:41.227318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7a3d5f9e1c42'
+down_revision: Union[str, None] = 'd2e9b4a71f06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('reserved_space', sa.BigInteger(), server_default='0', nullable=False))
+    # Upload sessions still open now are finalized against their reservation later
+    op.execute(
+        "UPDATE users SET reserved_space = sessions.size "
+        "FROM (SELECT owner_id, sum(size) AS size FROM upload_sessions GROUP BY owner_id) AS sessions "
+        "WHERE sessions.owner_id = users.email"
+    )
+    op.execute("UPDATE users SET space = 0 WHERE space IS NULL OR space < 0")
+    # Users pushed over their quota by concurrent uploads keep what they have
+    op.execute(
+        "UPDATE users SET max_space = space + reserved_space "
+        "WHERE space + reserved_space > max_space"
+    )
+    op.create_check_constraint(
+        'ck_users_space_within_quota',
+        'users',
+        'space >= 0 AND reserved_space >= 0 AND space + reserved_space <= max_space',
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint('ck_users_space_within_quota', 'users', type_='check')
+    op.drop_column('users', 'reserved_space')
@@ -0,0 +1,37 @@
+"""content addressed blobs
+
+Revision ID: 9c14f0e6a2d8
+Revises: 5b7e2d41c9a3
+Create Date: 2026-10-18 13:41:07.226519
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c14f0e6a2d8'
+down_revision: Union[str, None] = '5b7e2d41c9a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('blobs',
+    sa.Column('digest', sa.String(), nullable=False),
+    sa.Column('path', sa.String(), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('ref_count', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('digest')
+    )
+    op.add_column('uploads', sa.Column('blob_digest', sa.String(), nullable=True))
+    op.create_foreign_key('uploads_blob_digest_fkey', 'uploads', 'blobs', ['blob_digest'], ['digest'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uploads_blob_digest_fkey', 'uploads', type_='foreignkey')
+    op.drop_column('uploads', 'blob_digest')
+    op.drop_table('blobs')
@@ -0,0 +1,26 @@
+"""user change versions
+
+Revision ID: b4c8e2f1a9d3
+Revises: e61b0c8d4f27
+Create Date: 2026-10-18 18:26:13.540921
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4c8e2f1a9d3'
+down_revision: Union[str, None] = 'e61b0c8d4f27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('version', sa.BigInteger(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'version')
@@ -0,0 +1,40 @@
+"""shared recipient upload indexes
+
+Revision ID: c7d3a5e9f2b1
+Revises: b4c8e2f1a9d3
+Create Date: 2026-10-18 19:04:37.218554
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7d3a5e9f2b1'
+down_revision: Union[str, None] = 'b4c8e2f1a9d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Deleting an upload deletes its share recipients by either column
+INDEXES = [
+    ('ix_shared_recipients_upload_id', 'shared_recipients', ['upload_id']),
+    ('ix_shared_recipients_shared_upload_id', 'shared_recipients', ['shared_upload_id']),
+]
+
+
+def upgrade() -> None:
+    # Build the indexes without locking the table against writes
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True, if_exists=True)
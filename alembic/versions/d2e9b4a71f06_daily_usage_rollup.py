@@ -0,0 +1,40 @@
+"""daily usage rollup
+
+Revision ID: d2e9b4a71f06
+Revises: 3f8a6c2e7b15
+Create Date: 2026-10-18 14:32:18.650942
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2e9b4a71f06'
+down_revision: Union[str, None] = '3f8a6c2e7b15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('daily_usage',
+    sa.Column('user_email', sa.String(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('uploads', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_email'], ['users.email'], ),
+    sa.PrimaryKeyConstraint('user_email', 'day')
+    )
+    # Backfill the rollup from the existing uploads
+    op.execute(
+        "INSERT INTO daily_usage (user_email, day, size, uploads) "
+        "SELECT owner_id, created_at::date, sum(size), count(*) "
+        "FROM uploads WHERE owner_id IS NOT NULL AND created_at IS NOT NULL "
+        "GROUP BY owner_id, created_at::date"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('daily_usage')
@@ -0,0 +1,39 @@
+"""expiring upload reservations
+
+Revision ID: e3f1a7c5b9d2
+Revises: c7d3a5e9f2b1
+Create Date: 2026-10-18 20:41:52.306187
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3f1a7c5b9d2'
+down_revision: Union[str, None] = 'c7d3a5e9f2b1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('upload_sessions', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    # Open sessions count as active from now on, so none is expired by the first reconciler run
+    op.execute("UPDATE upload_sessions SET updated_at = now() AT TIME ZONE 'utc'")
+    op.create_table('quota_reservations',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('owner_id', sa.String(), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.email'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_quota_reservations_owner_id'), 'quota_reservations', ['owner_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_quota_reservations_owner_id'), table_name='quota_reservations')
+    op.drop_table('quota_reservations')
+    op.drop_column('upload_sessions', 'updated_at')
@@ -0,0 +1,31 @@
+"""legacy upload path index
+
+Revision ID: e61b0c8d4f27
+Revises: 7a3d5f9e1c42
+Create Date: 2026-10-18 17:12:09.804416
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e61b0c8d4f27'
+down_revision: Union[str, None] = '7a3d5f9e1c42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_uploads_legacy_path', 'uploads', ['path', 'id'], unique=False,
+                        postgresql_where=sa.text('blob_digest IS NULL'),
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_uploads_legacy_path', table_name='uploads',
+                      postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,26 @@
+"""upload session chunk lease
+
+Revision ID: f5a2c8d4b7e1
+Revises: e3f1a7c5b9d2
+Create Date: 2026-10-18 14:41:07.518230
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f5a2c8d4b7e1'
+down_revision: Union[str, None] = 'e3f1a7c5b9d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('upload_sessions', sa.Column('lease', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('upload_sessions', 'lease')
@@ -1,10 +1,16 @@
+import hmac
+import json
+import time
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from fastapi import Depends, status, HTTPException
+from fastapi import Depends, Request, status, HTTPException
 from pydantic import EmailStr
 from . import schema, models
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+from .cache import TTLCache, shared_cache
 from .config import settings
 
 
@@ -15,6 +21,18 @@ ALGORITHM = f"{settings.ALGORITHM}"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(settings.ACCESS_TOKEN_EXPIRE_MINUTES)
 REFRESH_TOKEN_EXPIRE_DAYS = int(settings.REFRESH_TOKEN_EXPIRE_DAYS)
 
+# Verified tokens (token -> email), per worker since checking a token needs no I/O.
+# User rows are kept in the shared cache, under `user:<email>`, for all workers.
+token_cache = TTLCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
+
+# Credentials are left out of the cached user rows, which Redis shares with whatever else can
+# read it: the password hash, and `sub`, which the demo login checks its password against
+CREDENTIAL_COLUMNS = {"password", "sub"}
+
+USER_COLUMNS = [
+    column.key for column in inspect(models.User).column_attrs if column.key not in CREDENTIAL_COLUMNS
+]
+
 
 def create_access_token(data: dict, give=True):
     to_encode = data.copy()
@@ -70,8 +88,46 @@ def verify_access_token(token: str, credentials_exception):
     return token_data
 
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme), db: Session = Depends(models.get_db)
+def verified_email(token: str, credentials_exception) -> str:
+    """
+    Returns the email of a valid access token, checking each token only once while cached.
+    """
+    email = token_cache.get(token)
+    if email is None:
+        email = verify_access_token(token, credentials_exception).email
+        # Never keep a token cached past its own expiry
+        expires_at = jwt.get_unverified_claims(token).get("exp", 0)
+        token_cache.set(token, email, ttl=expires_at - time.time())
+    return email
+
+
+def _dump_user(user: models.User) -> bytes:
+    row = {column: getattr(user, column) for column in USER_COLUMNS}
+    if row["created_at"] is not None:
+        row["created_at"] = row["created_at"].isoformat()
+    return json.dumps(row).encode()
+
+
+def _load_user(data: bytes) -> dict:
+    row = json.loads(data)
+    if row["created_at"] is not None:
+        row["created_at"] = datetime.fromisoformat(row["created_at"])
+    return row
+
+
+async def invalidate_user(email: str):
+    """
+    Drops the cached row of a user. Call this after changing the user's space or profile.
+    """
+    await shared_cache.delete(f"user:{email}")
+
+
+def get_auth_cache_stats():
+    return {"tokens": token_cache.stats(), "users": shared_cache.stats()}
+
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(models.get_async_db)
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -79,6 +135,40 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    token = verify_access_token(token, credentials_exception)
-    user = db.query(models.User).filter(models.User.email == token.email).first()
+    email = verified_email(token, credentials_exception)
+
+    data = await shared_cache.get(f"user:{email}")
+    if data is not None:
+        # Attach a copy of the cached row to this session without querying it; the
+        # credential columns are not loaded on it
+        user = models.User(**_load_user(data))
+        make_transient_to_detached(user)
+        db.add(user)
+        return user
+
+    result = await db.execute(
+        select(models.User).where(models.User.email == email)
+    )
+    user = result.scalars().first()
+    if user is None:
+        raise credentials_exception
+    await shared_cache.set(f"user:{email}", _dump_user(user), settings.AUTH_CACHE_TTL)
     return user
+
+
+def require_internal_token(request: Request):
+    """
+    Guards the internal endpoints, /metrics and /stats, with the `INTERNAL_TOKEN` bearer token.
+
+    They are refused to everyone while no token is configured.
+    """
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if not (
+        settings.INTERNAL_TOKEN
+        and scheme.lower() == "bearer"
+        and hmac.compare_digest(token.encode(), settings.INTERNAL_TOKEN.encode())
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="A valid internal token is required",
+        )
@@ -0,0 +1,324 @@
+import json
+import mimetypes
+import os
+import posixpath
+import struct
+import zipfile
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from functools import cached_property
+from urllib.parse import quote
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from api_app.cache import TTLCache
+from api_app.config import settings
+from api_app.downloads import FileRangeResponse, etag_matches, parse_range
+
+
+@dataclass(frozen=True)
+class ZipEntry:
+    name: str
+    size: int
+    compressed_size: int
+    crc: int
+    modified: str  # ISO 8601, or None if the archive holds an invalid date
+    is_dir: bool
+    compress_type: int
+    header_offset: int  # Position of the entry's local file header
+    encrypted: bool
+
+
+class ZipIndex:
+    """
+    The parsed central directory of a ZIP archive.
+
+    Entries are kept in archive order and by name. The JSON listing is rendered the
+    first time it is asked for and reused afterwards.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.by_name = {entry.name: entry for entry in entries}
+
+    @cached_property
+    def json(self) -> bytes:
+        return json.dumps(
+            [
+                {
+                    "name": entry.name,
+                    "size": entry.size,
+                    "compressed_size": entry.compressed_size,
+                    "crc": entry.crc,
+                    "modified": entry.modified,
+                    "is_dir": entry.is_dir,
+                }
+                for entry in self.entries
+            ]
+        ).encode()
+
+
+def _modified(date_time) -> str:
+    try:
+        return datetime(*date_time).isoformat()
+    except ValueError:
+        return None
+
+
+def read_zip_index(source) -> ZipIndex:
+    """
+    Reads the central directory of a ZIP archive, given as a path or a seekable file.
+
+    `zipfile` seeks to the end of central directory record and reads the directory
+    from there, so only the tail of the archive is read, whatever its size.
+
+    Raises:
+        zipfile.BadZipFile: If the file is not a readable ZIP archive.
+    """
+    with zipfile.ZipFile(source) as archive:
+        return ZipIndex([
+            ZipEntry(
+                name=info.filename,
+                size=info.file_size,
+                compressed_size=info.compress_size,
+                crc=info.CRC,
+                modified=_modified(info.date_time),
+                is_dir=info.is_dir(),
+                compress_type=info.compress_type,
+                header_offset=info.header_offset,
+                encrypted=bool(info.flag_bits & 0x1),
+            )
+            for info in archive.infolist()
+        ])
+
+
+zip_index_cache = TTLCache(settings.ZIP_INDEX_CACHE_SIZE, settings.ZIP_INDEX_CACHE_TTL)
+
+
+def get_zip_index(backend, key: str, digest: str = None) -> ZipIndex:
+    """
+    Returns the entry index of an archive, parsing it only on the first call.
+
+    Blobs never change, so their index is cached under the content digest and shared by
+    every upload of the same content. Files stored before deduplication are cached under
+    their path, modification time and size instead. Blocking; call it from the threadpool.
+    """
+    if digest:
+        cache_key = digest
+    else:
+        stat = os.stat(backend.local_path(key))
+        cache_key = (key, stat.st_mtime_ns, stat.st_size)
+
+    index = zip_index_cache.get(cache_key)
+    if index is None:
+        with backend.open(key) as archive:
+            index = read_zip_index(archive)
+        zip_index_cache.set(cache_key, index)
+    return index
+
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def member_data_offset(backend, key: str, entry: ZipEntry) -> int:
+    """
+    Returns the position of an entry's data, just past its local file header.
+
+    The header's name and extra fields may differ from the central directory, so their
+    lengths are read from the header itself.
+
+    Raises:
+        zipfile.BadZipFile: If there is no local file header at the recorded offset.
+    """
+    with backend.open(key) as archive:
+        archive.seek(entry.header_offset)
+        header = archive.read(LOCAL_HEADER.size)
+    if len(header) != LOCAL_HEADER.size:
+        raise zipfile.BadZipFile(f"Truncated local header for {entry.name}")
+    fields = LOCAL_HEADER.unpack(header)
+    if fields[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"Bad local header for {entry.name}")
+    name_length, extra_length = fields[-2:]
+    return entry.header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+
+def iter_deflated_member(backend, key: str, offset: int, entry: ZipEntry):
+    """
+    Inflates a deflated entry chunk by chunk, starting at `offset`.
+
+    At most `STREAM_CHUNK_SIZE` bytes are read or produced at a time, so memory stays
+    bounded even for highly compressed entries. The CRC is checked at the end and the
+    stream is aborted if it does not match.
+    """
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    received = 0
+    if entry.compressed_size:
+        end = offset + entry.compressed_size - 1
+        for data in backend.iter_range(key, offset, end, STREAM_CHUNK_SIZE):
+            received += len(data)
+            while data:
+                chunk = inflater.decompress(data, STREAM_CHUNK_SIZE)
+                data = inflater.unconsumed_tail
+                if chunk:
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+    if received != entry.compressed_size:
+        raise zipfile.BadZipFile(f"Truncated data for {entry.name}")
+    chunk = inflater.flush()
+    if chunk:
+        crc = zlib.crc32(chunk, crc)
+        yield chunk
+    if crc != entry.crc:
+        raise zipfile.BadZipFile(f"Bad CRC for {entry.name}")
+
+
+def iter_member(backend, key: str, entry: ZipEntry):
+    """
+    Streams an entry compressed with a method other than deflate through `zipfile`.
+    """
+    with backend.open(key) as source, zipfile.ZipFile(source) as archive, \
+            archive.open(entry.name) as member:
+        while chunk := member.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+
+async def zip_member_response(request: Request, backend, key: str, entry: ZipEntry, etag: str = None):
+    """
+    Builds the response streaming a single entry out of an archive.
+
+    Stored entries are sent as a byte range of the archive, without recompression, and
+    support `Range` requests like a download. Deflated entries are inflated as they are
+    sent. The archive is never read beyond the entry's local header and data.
+
+    Args:
+        request (Request): The request for the entry.
+        backend (StorageBackend): The backend holding the archive.
+        key (str): The key of the archive in the backend.
+        entry (ZipEntry): The entry to send, from the archive's index.
+        etag (str): The entity tag of the entry, including its quotes, if it has one.
+
+    Raises:
+        zipfile.BadZipFile: If the entry's local header is missing or damaged.
+
+    Returns:
+        Response: The response to send.
+    """
+    headers = {
+        "content-disposition": f"attachment; filename*=UTF-8''{quote(posixpath.basename(entry.name))}",
+    }
+    if etag:
+        headers["etag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"etag": etag})
+    media_type = mimetypes.guess_type(entry.name)[0] or "application/octet-stream"
+
+    offset = await run_in_threadpool(member_data_offset, backend, key, entry)
+
+    if entry.compress_type == zipfile.ZIP_STORED:
+        headers["accept-ranges"] = "bytes"
+        headers["content-type"] = media_type
+        try:
+            byte_range = parse_range(request.headers.get("range"), entry.size)
+        except ValueError:
+            return Response(status_code=416, headers={"content-range": f"bytes */{entry.size}"})
+        status_code, start, end = 200, 0, entry.size - 1
+        if byte_range is not None:
+            status_code, (start, end) = 206, byte_range
+            headers["content-range"] = f"bytes {start}-{end}/{entry.size}"
+
+        path = backend.local_path(key)
+        if path is not None:
+            return FileRangeResponse(path, offset + start, offset + end, status_code, headers)
+        headers["content-length"] = str(end - start + 1)
+        if entry.size == 0:
+            return Response(status_code=status_code, headers=headers)
+        return StreamingResponse(
+            backend.iter_range(key, offset + start, offset + end, STREAM_CHUNK_SIZE),
+            status_code=status_code,
+            headers=headers,
+        )
+
+    if entry.compress_type == zipfile.ZIP_DEFLATED:
+        content = iter_deflated_member(backend, key, offset, entry)
+    else:
+        content = iter_member(backend, key, entry)
+    # Sync iterators are run in the threadpool, one chunk at a time as the client reads them
+    return StreamingResponse(content, headers=headers, media_type=media_type)
+
+
+class _ZipSink:
+    """
+    A write-only stream that hands back what was written since the last `drain`.
+
+    `zipfile` treats it as unseekable and writes data descriptors after each member
+    instead of seeking back to patch the local headers.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        self._buffer.extend(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def bundle_member_names(names):
+    """
+    Makes archive member names unique by numbering repeated ones, e.g. `report (2).zip`.
+    """
+    seen = set()
+    unique = []
+    for name in names:
+        candidate = name
+        stem, dot, extension = name.rpartition(".")
+        if not stem:
+            stem, dot, extension = name, "", ""
+        number = 1
+        while candidate in seen:
+            number += 1
+            candidate = f"{stem} ({number}){dot}{extension}"
+        seen.add(candidate)
+        unique.append(candidate)
+    return unique
+
+
+def iter_zip_bundle(members):
+    """
+    Builds a ZIP archive of several files while it is being sent.
+
+    Members are written in stored mode, since uploads are ZIP archives already and would
+    not shrink any further. The archive is produced one `STREAM_CHUNK_SIZE` chunk at a time
+    and nothing is buffered beyond that chunk, so memory use is constant whatever the size
+    of the bundle. Zip64 records are used when a member or the archive needs them.
+
+    Args:
+        members: `(name, backend, key, modified, size)` tuples, one per file to include.
+
+    Yields:
+        bytes: The next part of the archive.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as bundle:
+        for name, backend, key, modified, size in members:
+            info = zipfile.ZipInfo(name, date_time=max(modified, datetime(1980, 1, 1)).timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = size
+            with bundle.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                if size:
+                    for chunk in backend.iter_range(key, 0, size - 1, STREAM_CHUNK_SIZE):
+                        member.write(chunk)
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,317 @@
+import io
+import os
+import shutil
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Tuple
+from api_app.config import settings
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+class StorageBackend(ABC):
+    """
+    Where the content of uploads is kept, addressed by key.
+
+    Blobs use their SHA-256 digest as key. Implementations are blocking; the
+    routes call them from the threadpool.
+    """
+
+    @abstractmethod
+    def location(self, key: str) -> str:
+        """
+        Returns a human readable location of the object, stored with its rows.
+        """
+
+    def local_path(self, key: str) -> Optional[str]:
+        """
+        Returns the path of the object on the local disk, or None if it is stored elsewhere.
+
+        A local path lets downloads use `sendfile` and `X-Accel-Redirect`.
+        """
+        return None
+
+    @abstractmethod
+    def put_file(self, source: Path, key: str):
+        """
+        Stores the local file `source` under `key`, replacing any object already there.
+
+        `source` is consumed: it is moved into place or removed once uploaded.
+        """
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        """
+        Opens the object for reading. The returned file supports `seek`.
+
+        Raises:
+            FileNotFoundError: If there is no object under `key`.
+        """
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        """
+        Raises:
+            FileNotFoundError: If there is no object under `key`.
+        """
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.size(key)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def iter_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Yields the bytes from `start` to `end` inclusive, one chunk at a time.
+        """
+        with self.open(key) as source:
+            source.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = source.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    @abstractmethod
+    def delete(self, key: str):
+        """
+        Removes the object. Does nothing if it does not exist.
+        """
+
+    @abstractmethod
+    def iter_keys(self) -> Iterator[Tuple[str, float]]:
+        """
+        Yields `(key, modified)` for every stored object, with `modified` as a Unix timestamp.
+        """
+
+
+class LocalBackend(StorageBackend):
+    """
+    Stores objects as files below `root`.
+
+    Files are spread over `shard_depth` levels of directories named after pairs of
+    characters of the key, e.g. `root/ab/cd/abcdef...` for a depth of 2. With hex digests
+    as keys that gives 65536 evenly filled directories, so none of them grows too large.
+    A depth of 0 uses the key as a path relative to `root`.
+    """
+
+    def __init__(self, root, shard_depth: int = 2):
+        self.root = Path(root)
+        self.shard_depth = shard_depth
+
+    def path(self, key: str) -> Path:
+        shards = [key[2 * level:2 * level + 2] for level in range(self.shard_depth)]
+        return self.root.joinpath(*shards, key)
+
+    def location(self, key: str) -> str:
+        return str(self.path(key))
+
+    def local_path(self, key: str) -> str:
+        return str(self.path(key))
+
+    def put_file(self, source: Path, key: str):
+        destination = self.path(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(source, destination)
+        except OSError:
+            # The staging area is on another filesystem
+            shutil.move(source, destination)
+
+    def open(self, key: str) -> BinaryIO:
+        return self.path(key).open("rb")
+
+    def size(self, key: str) -> int:
+        return os.stat(self.path(key)).st_size
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def iter_keys(self, folder: str = "", exclude=()):
+        """
+        Yields `(key, modified)` for every stored file, or only for those below `folder`.
+
+        With a shard depth of 0 keys are paths, so `folder` and the folders to skip in
+        `exclude` are given as key prefixes, e.g. `Uploads/blobs`.
+        """
+        # Directories are read one at a time so memory use doesn't depend on the number of files
+        excluded = {os.path.normpath(self.root / key) for key in exclude}
+        folders = [str(self.root / folder)]
+        while folders:
+            try:
+                with os.scandir(folders.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if os.path.normpath(entry.path) not in excluded:
+                                folders.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            key = entry.name if self.shard_depth else os.path.relpath(entry.path, self.root)
+                            yield key, entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+
+
+class S3Object(io.RawIOBase):
+    """
+    A seekable, read-only view of an S3 object that fetches what is read with ranged GETs.
+
+    Reading the end of a large archive, as `zipfile` does to find its central directory,
+    only transfers those bytes.
+    """
+
+    def __init__(self, client, bucket: str, key: str, size: int):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.length = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.length or not len(buffer):
+            return 0
+        end = min(self.position + len(buffer), self.length) - 1
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{end}"
+        )
+        data = response["Body"].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class S3Backend(StorageBackend):
+    """
+    Stores objects in an S3-compatible bucket (AWS S3, MinIO, Ceph, R2...) under `prefix`.
+
+    Keys are used as they are, since object stores have no directory size limits.
+    boto3 is only imported when the backend is first used, so it is not needed for
+    local storage.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: str = None,
+        region_name: str = None,
+        access_key_id: str = None,
+        secret_access_key: str = None,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region_name = region_name
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client(
+                "s3",
+                endpoint_url=self.endpoint_url,
+                region_name=self.region_name,
+                aws_access_key_id=self.access_key_id,
+                aws_secret_access_key=self.secret_access_key,
+            )
+        return self._client
+
+    def object_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def location(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self.object_key(key)}"
+
+    def put_file(self, source: Path, key: str):
+        # upload_file switches to multipart uploads for large files
+        self.client.upload_file(str(source), self.bucket, self.object_key(key))
+        os.remove(source)
+
+    def _head(self, key: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(self.location(key)) from e
+            raise
+
+    def size(self, key: str) -> int:
+        return self._head(key)["ContentLength"]
+
+    def open(self, key: str) -> BinaryIO:
+        raw = S3Object(self.client, self.bucket, self.object_key(key), self.size(key))
+        return io.BufferedReader(raw, buffer_size=CHUNK_SIZE)
+
+    def iter_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.object_key(key), Range=f"bytes={start}-{end}"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(self.location(key)) from e
+            raise
+        body = response["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def iter_keys(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):], item["LastModified"].timestamp()
+
+
+def create_backend() -> StorageBackend:
+    """
+    Builds the backend blobs are stored in, from `STORAGE_BACKEND` and its settings.
+    """
+    if settings.STORAGE_BACKEND == "local":
+        return LocalBackend(settings.STORAGE_LOCAL_ROOT, settings.STORAGE_SHARD_DEPTH)
+    if settings.STORAGE_BACKEND == "s3":
+        return S3Backend(
+            bucket=settings.S3_BUCKET,
+            prefix=settings.S3_PREFIX,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            region_name=settings.S3_REGION,
+            access_key_id=settings.S3_ACCESS_KEY_ID,
+            secret_access_key=settings.S3_SECRET_ACCESS_KEY,
+        )
+    raise ValueError(f"Unknown storage backend {settings.STORAGE_BACKEND!r}")
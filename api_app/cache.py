@@ -0,0 +1,204 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+from api_app.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    A bounded, thread-safe LRU cache whose entries expire after a time to live.
+
+    The least recently used entry is evicted once `maxsize` entries are stored.
+    Hits and misses are counted so the cache can be sized from real traffic.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        Returns the value stored under `key`, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Stores `value` under `key` for `ttl` seconds, or the cache's default time to live.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class MemoryStore:
+    """
+    The shared store used when no Redis server is configured.
+
+    Values live in a `TTLCache` in the worker's memory, so they are only shared by the
+    requests one worker serves. The methods are coroutines like those of `RedisStore`,
+    and don't await anything, so each call runs atomically on the event loop.
+    """
+
+    backend = "memory"
+
+    def __init__(self, maxsize: int):
+        self._cache = TTLCache(maxsize, float("inf"))
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._cache.set(key, value, ttl)
+
+    async def delete(self, key: str):
+        self._cache.pop(key)
+
+    async def incr(self, key: str, ttl: float) -> int:
+        count = (self._cache.get(key) or 0) + 1
+        self._cache.set(key, count, ttl)
+        return count
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {"backend": self.backend, **self._cache.stats()}
+
+
+class RedisStore:
+    """
+    Keeps values and counters in Redis, where every worker and every instance of the api
+    sees them.
+
+    Keys are prefixed so several deployments can share a server. Redis being unreachable
+    never fails a request: lookups miss, writes are skipped and counters read 0, the
+    problem is logged and the api carries on as if nothing was cached or limited.
+    `redis` is imported when the first connection is made.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url: str, prefix: str = "xendpal:"):
+        self.url = url
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio
+
+            self._client = redis.asyncio.Redis.from_url(
+                self.url, socket_timeout=1, socket_connect_timeout=1
+            )
+        return self._client
+
+    def _failed(self, operation: str, key: str, error: Exception):
+        self.errors += 1
+        logger.warning("Redis %s of %s failed: %s", operation, key, error)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            value = await self.client.get(self.prefix + key)
+        except Exception as e:
+            self._failed("get", key, e)
+            return None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        try:
+            await self.client.set(self.prefix + key, value, px=max(int(ttl * 1000), 1))
+        except Exception as e:
+            self._failed("set", key, e)
+
+    async def delete(self, key: str):
+        try:
+            await self.client.delete(self.prefix + key)
+        except Exception as e:
+            self._failed("delete", key, e)
+
+    async def incr(self, key: str, ttl: float) -> int:
+        """
+        Increments the counter under `key`, created with a time to live of `ttl` seconds.
+
+        Returns:
+            int: The new count, or 0 if Redis could not be reached.
+        """
+        try:
+            async with self.client.pipeline(transaction=True) as pipeline:
+                pipeline.incr(self.prefix + key)
+                pipeline.expire(self.prefix + key, max(int(ttl), 1))
+                count, _ = await pipeline.execute()
+            return count
+        except Exception as e:
+            self._failed("incr", key, e)
+            return 0
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def stats(self):
+        return {"backend": self.backend, "hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+
+def create_shared_store():
+    """
+    Builds the store shared by the workers: Redis at `REDIS_URL`, or memory without one.
+    """
+    if settings.REDIS_URL:
+        return RedisStore(settings.REDIS_URL)
+    return MemoryStore(settings.SHARED_CACHE_SIZE)
+
+
+shared_cache = create_shared_store()
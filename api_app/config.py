@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 
@@ -12,7 +13,9 @@ class Settings(BaseSettings):
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: int
     REFRESH_TOKEN_EXPIRE_DAYS: int
+    EMAIL_HOST: str = "smtp.gmail.com"
     EMAIL_PORT: int
+    EMAIL_USE_TLS: bool = True  # Use STARTTLS, turn off for a local debugging SMTP server
     EMAIL_HOST_USER: str  # Replace with your email address
     EMAIL_HOST_PASSWORD: str  # Replace with your email password
     USER_INFO_URL: str
@@ -20,6 +23,51 @@ class Settings(BaseSettings):
     REDIRECT_URI: str
     CLIENT_SECRET: str
     CLIENT_ID: str
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # Bytes read and written per upload chunk
+    DB_POOL_SIZE: int = 5  # Connections kept open in the pool
+    DB_MAX_OVERFLOW: int = 10  # Extra connections allowed above the pool size under load
+    DB_POOL_TIMEOUT: int = 30  # Seconds to wait for a free connection before failing
+    DB_POOL_RECYCLE: int = 1800  # Seconds after which a connection is replaced
+    DB_POOL_PRE_PING: bool = True  # Check connections are alive before using them
+    AUTH_CACHE_SIZE: int = 10000  # Verified tokens and user rows kept per worker
+    AUTH_CACHE_TTL: int = 60  # Seconds a cached token or user row stays valid
+    DOWNLOAD_ACCEL_REDIRECT_PREFIX: Optional[str] = None  # nginx internal location serving Uploads/
+    EMAIL_WORKERS: int = 2  # SMTP connections used to deliver queued email
+    EMAIL_QUEUE_SIZE: int = 1000  # Emails waiting for delivery before new ones are dropped
+    EMAIL_BATCH_SIZE: int = 20  # Emails sent over one SMTP session before checking the queue again
+    EMAIL_MAX_RETRIES: int = 3
+    EMAIL_RETRY_BACKOFF: float = 1.0  # Seconds before the first retry, doubled on each attempt
+    EMAIL_IDLE_TIMEOUT: float = 30.0  # Seconds an idle SMTP session is kept open
+    ZIP_INDEX_CACHE_SIZE: int = 256  # Parsed ZIP central directories kept per worker
+    ZIP_INDEX_CACHE_TTL: int = 3600  # Seconds a parsed central directory stays cached
+    QUOTA_RESERVATION_EXTENT: int = 64 * 1024 * 1024  # Bytes of quota reserved at a time while an upload streams in
+    QUOTA_RESERVATION_TTL: int = 600  # Seconds without progress after which the reconciler releases an upload's reservation
+    UPLOAD_SESSION_TTL: int = 24 * 3600  # Seconds without a chunk after which the reconciler expires an upload session
+    UPLOAD_CHUNK_LEASE_TTL: int = 300  # Seconds a chunk may go without receiving data before another request can write to its session
+    STORAGE_BACKEND: str = "local"  # Where upload content is kept: "local" or "s3"
+    STORAGE_LOCAL_ROOT: str = "Uploads/blobs"
+    STORAGE_SHARD_DEPTH: int = 2  # Levels of directories blobs are spread over on local disk
+    S3_BUCKET: Optional[str] = None
+    S3_PREFIX: str = "blobs/"
+    S3_ENDPOINT_URL: Optional[str] = None  # For S3-compatible stores such as MinIO
+    S3_REGION: Optional[str] = None
+    S3_ACCESS_KEY_ID: Optional[str] = None  # Falls back to the usual AWS credential chain
+    S3_SECRET_ACCESS_KEY: Optional[str] = None
+    REDIS_URL: Optional[str] = None  # e.g. redis://localhost:6379/0, shares caches and rate limits between workers
+    SHARED_CACHE_SIZE: int = 10000  # Entries kept per worker when there is no Redis
+    LISTING_CACHE_TTL: int = 300  # Seconds a rendered page of /file/user_items is kept
+    RATE_LIMIT_WINDOW: int = 60  # Seconds the rate limits below are counted over
+    RATE_LIMIT_UPLOADS_PER_USER: int = 30  # Uploads per window; 0 turns a limit off
+    RATE_LIMIT_UPLOADS_PER_IP: int = 60
+    RATE_LIMIT_SHARES_PER_USER: int = 60  # Share requests per window, bulk ones included
+    RATE_LIMIT_SHARES_PER_IP: int = 120
+    RATE_LIMIT_LOGINS_PER_IP: int = 20  # Login and token refresh attempts per window
+    SLOW_QUERY_THRESHOLD_MS: float = 200.0  # Statements slower than this are logged with their route
+    PROFILE_SAMPLE_RATE: float = 0.0  # Fraction of requests profiled, e.g. 0.001
+    PROFILE_TOKEN: Optional[str] = None  # Requests sending it in an X-Profile header are profiled
+    PROFILE_INTERVAL: float = 0.005  # Seconds between two stack samples
+    PROFILE_FOLDER: str = "profiles"  # Where profiles are saved, as folded stacks
+    INTERNAL_TOKEN: Optional[str] = None  # Bearer token for /metrics and /stats, which are refused without one
 
     class Config:
         env_file = ".env"
@@ -1,12 +1,116 @@
+import time
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
 from api_app.config import settings
 from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.DATABASE_USER}:{settings.DATABASE_PASSWORD}@{settings.DATABASE_HOST}:{settings.DATABASE_PORT}/{settings.DATABASE_NAME}"
+ASYNC_SQLALCHEMY_DATABASE_URL = f"postgresql+asyncpg://{settings.DATABASE_USER}:{settings.DATABASE_PASSWORD}@{settings.DATABASE_HOST}:{settings.DATABASE_PORT}/{settings.DATABASE_NAME}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+POOL_OPTIONS = {
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_timeout": settings.DB_POOL_TIMEOUT,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+    "pool_pre_ping": settings.DB_POOL_PRE_PING,
+}
+
+# The engines are created on first use rather than at import, which would load both
+# database drivers in every process importing the models. The api creates its async
+# engine in the app's lifespan; the session factories are bound once it exists.
+_engine = None
+_async_engine = None
+
+SessionLocal = sessionmaker(autoflush=False, autocommit=False)
+
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+
+def get_engine():
+    """
+    Returns the synchronous engine, used by scripts and tooling outside of the request path.
+    """
+    global _engine
+    if _engine is None:
+        _engine = create_engine(SQLALCHEMY_DATABASE_URL, **POOL_OPTIONS)
+        SessionLocal.configure(bind=_engine)
+    return _engine
+
+
+def get_async_engine():
+    """
+    Returns the asynchronous engine used by the API so database waits yield to the event loop.
+    """
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, **POOL_OPTIONS)
+        AsyncSessionLocal.configure(bind=_async_engine)
+    return _async_engine
+
+
+async def dispose_async_engine():
+    """
+    Closes the connections in the async engine's pool, e.g. when the api shuts down.
+    """
+    if _async_engine is not None:
+        await _async_engine.dispose()
 
-SessionLocal = sessionmaker(autoflush=False, bind=engine, autocommit=False)
 
 Base = declarative_base()
+
+
+class PoolStats:
+    """
+    Keeps track of how long requests wait to check a connection out of the pool.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_checkout(self, wait: float):
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def record_timeout(self):
+        self.timeouts += 1
+
+
+pool_stats = PoolStats()
+
+
+def get_pool_status():
+    """
+    Returns live statistics for the API's connection pool.
+    """
+    pool = get_async_engine().pool
+    average_wait = pool_stats.total_wait / pool_stats.checkouts if pool_stats.checkouts else 0.0
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "checkouts": pool_stats.checkouts,
+        "timeouts": pool_stats.timeouts,
+        "average_wait_ms": round(average_wait * 1000, 3),
+        "max_wait_ms": round(pool_stats.max_wait * 1000, 3),
+    }
+
+
+async def checkout_connection(db):
+    """
+    Checks out the connection of an async session up front, recording how long it took.
+    """
+    start = time.perf_counter()
+    try:
+        await db.connection()
+    except PoolTimeoutError:
+        pool_stats.record_timeout()
+        raise
+    pool_stats.record_checkout(time.perf_counter() - start)
@@ -0,0 +1,225 @@
+import os
+from urllib.parse import quote
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from api_app.config import settings
+
+
+def parse_range(header: str, size: int):
+    """
+    Parses a `Range` header into an inclusive `(start, end)` byte range.
+
+    Returns None when the header should be ignored (missing, malformed, not in bytes
+    or asking for several ranges), in which case the whole file is served.
+
+    Raises:
+        ValueError: If the range cannot be satisfied for a file of `size` bytes.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+
+    if start is None:
+        # Suffix range: the last `end` bytes
+        if not end or size == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - end, 0), size - 1
+
+    if end is None:
+        end = size - 1
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    candidates = [candidate.strip().removeprefix("W/") for candidate in header.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+class FileRangeResponse(Response):
+    """
+    Sends a byte range of a file without loading it into memory.
+
+    If the server supports the ASGI zero-copy extension the file descriptor is handed
+    to it so the kernel can `sendfile` the data. Otherwise the range is read with
+    `os.pread` in the threadpool, one chunk at a time.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.length = end - start + 1
+        self.send_body = send_body
+        self.headers["content-length"] = str(self.length)
+
+    async def __call__(self, scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if not self.send_body or self.length <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        file = await run_in_threadpool(open, self.path, "rb")
+        try:
+            if "http.response.zerocopy" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": file,
+                    "offset": self.start,
+                    "count": self.length,
+                    "more_body": False,
+                })
+                return
+
+            position, remaining = self.start, self.length
+            while remaining > 0:
+                chunk = await run_in_threadpool(
+                    os.pread, file.fileno(), min(self.chunk_size, remaining), position
+                )
+                if not chunk:
+                    break
+                position += len(chunk)
+                remaining -= len(chunk)
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": remaining > 0,
+                })
+            if remaining > 0:
+                # The file shrank underneath us; end the response anyway
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            await run_in_threadpool(file.close)
+
+
+def _download_headers(etag: str, filename: str) -> dict:
+    return {
+        "etag": etag,
+        "accept-ranges": "bytes",
+        "content-disposition": f"attachment; filename*=UTF-8''{quote(filename or 'download')}",
+    }
+
+
+def _requested_range(request: Request, etag: str, size: int):
+    """
+    Returns the byte range to send, or None for the whole file.
+
+    `If-Range` disables the range when the file has changed. It uses the strong
+    comparison, so a weak validator (the `W/` ETag of a legacy file) never matches.
+
+    Raises:
+        ValueError: If the range cannot be satisfied.
+    """
+    if_range = request.headers.get("if-range")
+    if if_range and (if_range.strip() != etag or etag.startswith("W/")):
+        return None
+    return parse_range(request.headers.get("range"), size)
+
+
+async def file_download_response(request: Request, path: str, etag: str, filename: str, media_type: str = "application/zip"):
+    """
+    Builds the response for downloading a file, honouring conditional and range requests.
+
+    - `If-None-Match` matching `etag` gives `304 Not Modified`.
+    - A single `Range` gives `206 Partial Content`, or `416` if it cannot be satisfied.
+      `If-Range` disables the range when the file has changed.
+    - With `DOWNLOAD_ACCEL_REDIRECT_PREFIX` set, the transfer is delegated to the
+      fronting nginx through `X-Accel-Redirect`, which handles ranges and uses sendfile.
+
+    Args:
+        request (Request): The download request.
+        path (str): The location of the file on disk.
+        etag (str): The entity tag of the file, including its quotes.
+        filename (str): The name the client should save the file as.
+        media_type (str): The content type of the file.
+
+    Returns:
+        Response: The response to send.
+    """
+    headers = _download_headers(etag, filename)
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"etag": etag})
+
+    if settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX:
+        headers["x-accel-redirect"] = f"{settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(path)}"
+        return Response(status_code=200, headers=headers, media_type=media_type)
+
+    size = (await run_in_threadpool(os.stat, path)).st_size
+    send_body = request.method != "HEAD"
+
+    try:
+        byte_range = _requested_range(request, etag, size)
+    except ValueError:
+        return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+
+    headers["content-type"] = media_type
+    if byte_range is None:
+        return FileRangeResponse(path, 0, size - 1, 200, headers, send_body)
+
+    start, end = byte_range
+    headers["content-range"] = f"bytes {start}-{end}/{size}"
+    return FileRangeResponse(path, start, end, 206, headers, send_body)
+
+
+async def backend_download_response(request: Request, backend, key: str, etag: str, filename: str, media_type: str = "application/zip"):
+    """
+    Builds the response for downloading an object from a storage backend.
+
+    Objects on the local disk are sent with `file_download_response`. Others are streamed
+    from the backend with the same conditional and range handling, fetching only the
+    requested range.
+
+    Raises:
+        FileNotFoundError: If the backend has no object under `key`.
+    """
+    path = backend.local_path(key)
+    if path is not None:
+        return await file_download_response(request, path, etag, filename, media_type)
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"etag": etag})
+
+    size = await run_in_threadpool(backend.size, key)
+    headers = _download_headers(etag, filename)
+
+    try:
+        byte_range = _requested_range(request, etag, size)
+    except ValueError:
+        return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        status_code = 206
+        start, end = byte_range
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+    headers["content-length"] = str(end - start + 1)
+
+    if request.method == "HEAD" or size == 0:
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        backend.iter_range(key, start, end),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type,
+    )
@@ -1,28 +1,77 @@
-import smtplib
+import re
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from jinja2 import Environment, FileSystemLoader
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING
 from api_app.config import settings
-import os
-from premailer import Premailer
+from api_app.mailer import mailer
 
+if TYPE_CHECKING:
+    from jinja2 import Template
 
-def send_share_email(email, subject, template_data, template_name="sharetemplate.html"):
-    # Set the template folder as an environment variable
-    os.environ["TEMPLATE_FOLDER"] = "api_app/templates"
 
-    template_folder = os.environ.get("TEMPLATE_FOLDER")
+TEMPLATE_FOLDER = Path(__file__).parent / "templates"
+
+# Jinja expressions and statements, hidden from Premailer while the CSS is inlined
+_JINJA_TAG = re.compile(r"\{\{.*?\}\}|\{%.*?%\}", re.DOTALL)
+
+# premailer and jinja2 are only imported once the first template is compiled
+_environment = None
+_templates = {}
+
+
+def inline_template_css(source: str) -> str:
+    """
+    Inlines the CSS of an HTML email template without disturbing its Jinja tags.
+
+    Premailer parses the document as HTML and would URL-encode tags used in
+    attributes such as `href`, so each tag is swapped for a plain placeholder
+    while the styles are inlined and put back afterwards.
+    """
+    from premailer import Premailer
+
+    tags = []
+
+    def hide(match):
+        tags.append(match.group(0))
+        return f"jinjatag{len(tags) - 1}x"
+
+    inlined = Premailer(_JINJA_TAG.sub(hide, source)).transform()
+    return re.sub(r"jinjatag(\d+)x", lambda match: tags[int(match.group(1))], inlined)
+
+
+def get_email_template(template_name: str) -> "Template":
+    """
+    Returns the compiled template with its CSS already inlined.
+
+    Templates are read, inlined and compiled the first time they are used and
+    kept for the life of the process, so rendering a message only substitutes
+    its variables.
+    """
+    global _environment
+    template = _templates.get(template_name)
+    if template is None:
+        if _environment is None:
+            from jinja2 import Environment
 
-    # Initialize the Jinja2 environment with the template folder
-    env = Environment(loader=FileSystemLoader(template_folder))
+            _environment = Environment()
+        source = (TEMPLATE_FOLDER / template_name).read_text(encoding="utf-8")
+        template = _environment.from_string(inline_template_css(source))
+        _templates[template_name] = template
+    return template
 
-    # Get the provided template name
-    template = env.get_template(template_name)
-    message = template.render(**template_data)
 
-    # Inline CSS styles using Premailer
-    premailer = Premailer(message)
-    message_with_inline_css = premailer.transform()
+def load_email_templates():
+    """
+    Compiles every email template up front so the first emails don't pay for it.
+    """
+    for path in TEMPLATE_FOLDER.glob("*.html"):
+        get_email_template(path.name)
+
+
+def build_share_email(email, subject, template_data, template_name="sharetemplate.html"):
+    message_with_inline_css = get_email_template(template_name).render(**template_data)
 
     # Create a MIMEMultipart object
     msg = MIMEMultipart("alternative")
@@ -40,7 +89,34 @@ def send_share_email(email, subject, template_data, template_name="sharetemplate
     msg["From"] = settings.EMAIL_HOST_USER
     msg["To"] = email
 
-    with smtplib.SMTP("smtp.gmail.com", 587) as smtp:
-        smtp.starttls()
-        smtp.login(settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD)
-        smtp.send_message(msg)
+    return msg
+
+
+def send_share_email(email, subject, template_data, template_name="sharetemplate.html"):
+    """
+    Queues a share notification for delivery by the mailer.
+
+    The message is rendered by the mailer's worker threads, so this never blocks.
+
+    Returns:
+        bool: False if the mail queue is full and the email was dropped.
+    """
+    return mailer.enqueue(
+        partial(build_share_email, email, subject, template_data, template_name)
+    )
+
+
+def send_share_emails(emails, template_name="sharetemplate.html"):
+    """
+    Queues a batch of share notifications in one go.
+
+    Args:
+        emails: `(email, subject, template_data)` tuples, one per notification.
+
+    Returns:
+        int: The number of emails accepted by the mail queue.
+    """
+    return mailer.enqueue_many(
+        partial(build_share_email, email, subject, template_data, template_name)
+        for email, subject, template_data in emails
+    )
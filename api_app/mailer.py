@@ -0,0 +1,240 @@
+import logging
+import queue
+import sys
+import threading
+import time
+from api_app.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Mailer:
+    """
+    Delivers email from a bounded in-process queue over persistent SMTP connections.
+
+    Each worker thread keeps its own SMTP session open while there is mail to send,
+    so several messages share one connection, STARTTLS handshake and login. Sessions
+    are closed after `idle_timeout` seconds without mail and reopened on demand. A
+    message that fails with a temporary error is retried on a fresh connection with
+    exponential backoff; permanent errors (5xx) are not retried.
+
+    Queue items are either email messages or zero-argument callables returning one,
+    which lets the caller defer rendering to the worker threads. `smtplib` is imported
+    by the worker threads when they first deliver, not when the api starts.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str = None,
+        password: str = None,
+        use_tls: bool = True,
+        workers: int = 2,
+        queue_size: int = 1000,
+        batch_size: int = 20,
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+        idle_timeout: float = 30.0,
+        timeout: float = 30.0,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        self.connections = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"mailer-{number}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Stops the workers once the mail already queued has been sent.
+        """
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        self._threads = []
+
+    def enqueue(self, message) -> bool:
+        """
+        Queues a message for delivery without blocking.
+
+        Returns:
+            bool: False if the queue is full and the message was dropped.
+        """
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self._count("dropped")
+            logger.warning("Mail queue full, dropping message")
+            return False
+
+    def enqueue_many(self, messages) -> int:
+        """
+        Queues several messages. Returns the number that were accepted.
+        """
+        return sum(self.enqueue(message) for message in messages)
+
+    def room(self) -> int:
+        """
+        Returns how many more messages the queue can take right now.
+        """
+        if self.queue.maxsize <= 0:
+            return sys.maxsize
+        return self.queue.maxsize - self.queue.qsize()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retries": self.retries,
+            "connections": self.connections,
+        }
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _connect(self):
+        import smtplib
+
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls()
+            if self.password:
+                smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        self._count("connections")
+        return smtp
+
+    @staticmethod
+    def _disconnect(smtp):
+        import smtplib
+
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _run(self):
+        smtp = None
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout if smtp else None)
+            except queue.Empty:
+                # Nothing to send for a while; don't hold the session open
+                self._disconnect(smtp)
+                smtp = None
+                continue
+            if item is _STOP:
+                break
+
+            # Send whatever else is already waiting over the same session
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            for item in batch:
+                smtp = self._deliver(smtp, item)
+
+        if smtp:
+            self._disconnect(smtp)
+
+    def _deliver(self, smtp, item):
+        import smtplib
+
+        try:
+            message = item() if callable(item) else item
+        except Exception:
+            self._count("failed")
+            logger.exception("Could not build email message")
+            return smtp
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                if smtp is None:
+                    smtp = self._connect()
+                smtp.send_message(message)
+                self._count("sent")
+                return smtp
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code >= 500:
+                    self._count("failed")
+                    logger.error("Email to %s rejected: %s", message["To"], e)
+                    return smtp
+                error = e
+            except smtplib.SMTPRecipientsRefused as e:
+                self._count("failed")
+                logger.error("Email to %s rejected: %s", message["To"], e)
+                return smtp
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+
+            # Temporary failure: drop the connection and retry on a new one
+            if smtp is not None:
+                self._disconnect(smtp)
+                smtp = None
+            if attempt < self.max_retries:
+                self._count("retries")
+                time.sleep(self.retry_backoff * 2**attempt)
+
+        self._count("failed")
+        logger.error("Giving up on email to %s: %s", message["To"], error)
+        return smtp
+
+
+mailer = Mailer(
+    host=settings.EMAIL_HOST,
+    port=settings.EMAIL_PORT,
+    username=settings.EMAIL_HOST_USER,
+    password=settings.EMAIL_HOST_PASSWORD,
+    use_tls=settings.EMAIL_USE_TLS,
+    workers=settings.EMAIL_WORKERS,
+    queue_size=settings.EMAIL_QUEUE_SIZE,
+    batch_size=settings.EMAIL_BATCH_SIZE,
+    max_retries=settings.EMAIL_MAX_RETRIES,
+    retry_backoff=settings.EMAIL_RETRY_BACKOFF,
+    idle_timeout=settings.EMAIL_IDLE_TIMEOUT,
+)
@@ -1,13 +1,36 @@
 import json
 import random
+import threading
+from contextlib import asynccontextmanager
 from fastapi.responses import JSONResponse
 from fastapi import FastAPI, Depends
-from api_app.routers import users, files
+from api_app.routers import users, files, stats
 from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response
 from fastapi.exceptions import HTTPException
+from api_app.extras import load_email_templates
+from api_app.database import dispose_async_engine, get_async_engine
+from api_app.mailer import mailer
+from api_app.Oauth2 import require_internal_token
+from api_app.metrics import CONTENT_TYPE, MetricsMiddleware, instrument_engine, registry
+from api_app.profiling import ProfilingMiddleware
+from api_app.ratelimit import RateLimitMiddleware
+from api_app.cache import shared_cache
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    instrument_engine(get_async_engine().sync_engine)
+    # Compile the email templates in the background, so the worker starts serving
+    # without waiting for premailer and jinja2 to load
+    threading.Thread(target=load_email_templates, name="email-templates", daemon=True).start()
+    # Start the SMTP workers with the app and let them drain the queue on shutdown
+    mailer.start()
+    yield
+    mailer.stop()
+    await shared_cache.close()
+    await dispose_async_engine()
 
 
 app = FastAPI(
@@ -15,27 +38,45 @@ app = FastAPI(
     summary="This is the api for Xendpal.com ",
     description="Xendpal - An online file sharing platform -",
     version="latest",
+    lifespan=lifespan,
 )
 
 
-app.mount("/Uploads", StaticFiles(directory="Uploads"), name="Uploads")
-
 origins = ["*"]
 
 
+# Inside CORS, so browsers can read the 429 responses
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Accept-Ranges", "Content-Range", "Content-Disposition"],
 )
 
+app.add_middleware(ProfilingMiddleware)
+# Outermost, so the time spent in the other middleware is measured too
+app.add_middleware(MetricsMiddleware)
+
 
 @app.get("/")
 async def Xendpal():
     return RedirectResponse(url="/redoc", status_code=302)
 
 
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(require_internal_token)])
+async def metrics():
+    """
+    Exposes the api's metrics in the Prometheus text format, for scraping.
+
+    The scraper sends `INTERNAL_TOKEN` as a bearer token (`authorization` in the Prometheus
+    scrape config).
+    """
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
 app.include_router(users.router)
 app.include_router(files.router)
+app.include_router(stats.router)
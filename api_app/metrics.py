@@ -0,0 +1,340 @@
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from sqlalchemy import event
+from starlette.routing import Match
+from api_app.config import settings
+from api_app.mailer import mailer
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values.
+
+    Label values must come from a small, fixed set (route templates, methods, status
+    codes), never from user input such as emails or ids, so the number of samples stays
+    bounded. A metric built with `function` has no stored value; the function is called
+    whenever the metric is scraped.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels: dict):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yields `(name, labels, value)` for every sample, with labels as `(name, value)` pairs.
+        """
+        if self.function is not None:
+            yield self.name, (), self.function()
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Counts observations in cumulative buckets, along with their sum and count.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    """
+    The metrics exposed on `/metrics`, rendered in the Prometheus text format.
+
+    Values are kept per worker process, like the `/stats` endpoints; with several
+    workers every scrape reports the worker that served it.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return ("\n".join(lines) + "\n").encode()
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    "xendpal_http_requests_total", "HTTP requests handled, by route template and status.",
+    ["method", "route", "status"],
+))
+request_duration = registry.register(Histogram(
+    "xendpal_http_request_duration_seconds", "Time to handle a request, including sending the response.",
+    ["method", "route"],
+))
+requests_in_flight = registry.register(Gauge(
+    "xendpal_http_requests_in_flight", "Requests being handled right now.",
+))
+request_bytes = registry.register(Counter(
+    "xendpal_http_request_bytes_total", "Request body bytes received, i.e. uploaded.",
+    ["method", "route"],
+))
+response_bytes = registry.register(Counter(
+    "xendpal_http_response_bytes_total",
+    "Response body bytes sent by the api, i.e. served. Files sent by nginx through X-Accel-Redirect are not included.",
+    ["method", "route"],
+))
+quota_rejections = registry.register(Counter(
+    "xendpal_quota_rejections_total", "Uploads refused because the user's quota was used up.",
+))
+queries_total = registry.register(Counter(
+    "xendpal_db_queries_total", "SQL statements executed.",
+))
+query_seconds_total = registry.register(Counter(
+    "xendpal_db_query_seconds_total", "Time spent executing SQL statements.",
+))
+request_queries = registry.register(Histogram(
+    "xendpal_db_queries_per_request", "SQL statements executed per request.",
+    ["method", "route"], buckets=QUERY_COUNT_BUCKETS,
+))
+request_query_seconds = registry.register(Histogram(
+    "xendpal_db_query_seconds_per_request", "Time spent executing SQL statements per request.",
+    ["method", "route"],
+))
+email_queue_depth = registry.register(Gauge(
+    "xendpal_email_queue_depth", "Emails waiting for delivery.",
+    function=lambda: mailer.queue.qsize(),
+))
+emails_sent = registry.register(Counter(
+    "xendpal_emails_sent_total", "Emails delivered to the SMTP server.",
+    function=lambda: mailer.sent,
+))
+emails_failed = registry.register(Counter(
+    "xendpal_emails_failed_total", "Emails given up on after a permanent error or too many retries.",
+    function=lambda: mailer.failed,
+))
+emails_dropped = registry.register(Counter(
+    "xendpal_emails_dropped_total", "Emails dropped because the queue was full.",
+    function=lambda: mailer.dropped,
+))
+email_retries = registry.register(Counter(
+    "xendpal_email_retries_total", "Delivery attempts retried after a temporary error.",
+    function=lambda: mailer.retries,
+))
+
+
+class RequestQueries:
+    """
+    The number of SQL statements a request executed and the time they took.
+    """
+
+    __slots__ = ("route", "count", "duration")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.count = 0
+        self.duration = 0.0
+
+
+_request_queries = ContextVar("request_queries", default=None)
+
+
+def instrument_engine(engine):
+    """
+    Times every statement executed on `engine`, a synchronous engine or the `sync_engine`
+    of an async one, and adds it to the current request's totals.
+
+    Statements taking longer than `SLOW_QUERY_THRESHOLD_MS` are logged along with the
+    route that ran them. Only the SQL is logged, never its parameters.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start_time"].pop()
+        queries_total.inc()
+        query_seconds_total.inc(duration)
+        queries = _request_queries.get()
+        if queries is not None:
+            queries.count += 1
+            queries.duration += duration
+        if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+            logger.warning(
+                "Slow query on %s (%.1f ms): %s",
+                queries.route if queries is not None else "no request", duration * 1000, statement,
+            )
+
+
+def route_template(scope) -> str:
+    """
+    Returns the path template of the route matching the request, e.g. `/file/download/{upload_id}`.
+
+    Requests no route matches are grouped under `unmatched`, so scanners probing random
+    paths can't create new label values.
+    """
+    partial = None
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Records the latency, status, body sizes and SQL statements of every HTTP request.
+
+    A plain ASGI middleware, so streamed and zero-copy responses pass through untouched;
+    their bytes are counted as they are sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        received = 0
+        sent = 0
+
+        async def receive_counted():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def send_counted(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif message["type"] == "http.response.zerocopy":
+                sent += message.get("count") or 0
+            await send(message)
+
+        method = scope["method"]
+        route = route_template(scope)
+        queries = RequestQueries(f"{method} {route}")
+        token = _request_queries.set(queries)
+        requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            duration = time.perf_counter() - start
+            requests_in_flight.dec()
+            _request_queries.reset(token)
+
+            requests_total.inc(method=method, route=route, status=str(status))
+            request_duration.observe(duration, method=method, route=route)
+            request_bytes.inc(received, method=method, route=route)
+            response_bytes.inc(sent, method=method, route=route)
+            request_queries.observe(queries.count, method=method, route=route)
+            request_query_seconds.observe(queries.duration, method=method, route=route)
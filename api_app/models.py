@@ -1,14 +1,18 @@
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
-from api_app.database import SessionLocal
+from api_app.database import AsyncSessionLocal, SessionLocal, checkout_connection, get_async_engine, get_engine
 from sqlalchemy import (
     BigInteger,
+    CheckConstraint,
     Column,
+    Date,
     DateTime,
     Integer,
     String,
     ForeignKey,
+    Index,
+    text,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import declarative_base
@@ -25,17 +29,26 @@ Base = declarative_base()
 class User(Base):
     __tablename__ = "users"
     email = Column(String, primary_key=True, unique=True)
-    sub = Column(String)
+    sub = Column(String, index=True)
     name = Column(String)
     picture = Column(String)
-    space = Column(Integer, default=0)  # Current space used
+    space = Column(BigInteger, default=0)  # Current space used
+    reserved_space = Column(BigInteger, default=0, server_default="0", nullable=False)  # Space held by uploads in progress
     max_space = Column(BigInteger, default=2147483648)
+    version = Column(BigInteger, default=0, server_default="0", nullable=False)  # Bumped on every change the user can see
     password = Column(String)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     uploads = relationship("Upload", back_populates="owner")  # Relationship to uploads
     # Defining the relationship with History
     history_entries = relationship("History", back_populates="user")
 
+    __table_args__ = (
+        CheckConstraint(
+            "space >= 0 AND reserved_space >= 0 AND space + reserved_space <= max_space",
+            name="ck_users_space_within_quota",
+        ),
+    )
+
 
 class Upload(Base):
     __tablename__ = "uploads"
@@ -44,17 +57,41 @@ class Upload(Base):
     path = Column(String)
     type = Column(String)  # Could be 'file' or 'folder'
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    size = Column(Integer)
+    size = Column(BigInteger)
     owner_id = Column(String, ForeignKey("users.email"))
     owner = relationship("User", back_populates="uploads")
+    blob_digest = Column(String, ForeignKey("blobs.digest"))  # Content stored in this blob
+    blob = relationship("Blob")
 
     shared_recipients = relationship("SharedRecipient", back_populates="upload")
 
+    __table_args__ = (
+        Index("ix_uploads_owner_id_created_at_id", "owner_id", "created_at", "id"),
+        Index("ix_uploads_created_at", "created_at"),
+        Index("ix_uploads_blob_digest", "blob_digest"),
+        # Uploads stored before deduplication, looked up by path when reconciling
+        Index(
+            "ix_uploads_legacy_path",
+            "path",
+            "id",
+            postgresql_where=text("blob_digest IS NULL"),
+        ),
+    )
+
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    digest = Column(String, primary_key=True)  # SHA-256 of the content
+    path = Column(String)
+    size = Column(BigInteger)
+    ref_count = Column(Integer, default=0)  # Number of uploads pointing at this blob
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
 
 class SharedUpload(Base):
     __tablename__ = "shared_uploads"
     id = Column(String, primary_key=True, default=generate_uuid)
-    upload_id = Column(String, ForeignKey("uploads.id"))
+    upload_id = Column(String, ForeignKey("uploads.id"), index=True)
     upload = relationship("Upload")  # Relationship to the upload
     time_shared = Column(DateTime, default=datetime.datetime.utcnow)
     permission = Column(String)  # e.g., 'read', 'write'
@@ -67,14 +104,53 @@ class SharedUpload(Base):
 class SharedRecipient(Base):
     __tablename__ = "shared_recipients"
     id = Column(String, primary_key=True, default=generate_uuid)
-    shared_upload_id = Column(String, ForeignKey("shared_uploads.id"))
+    shared_upload_id = Column(String, ForeignKey("shared_uploads.id"), index=True)
     shared_upload = relationship("SharedUpload", back_populates="recipients")
     recipient_email = Column(String)
     upload_id = Column(
-        String, ForeignKey("uploads.id")
+        String, ForeignKey("uploads.id"), index=True
     )  # Corrected foreign key relationship
     upload = relationship("Upload", back_populates="shared_recipients")
 
+    __table_args__ = (
+        Index(
+            "ix_shared_recipients_recipient_email_shared_upload_id",
+            "recipient_email",
+            "shared_upload_id",
+        ),
+    )
+
+
+class DailyUsage(Base):
+    __tablename__ = "daily_usage"
+    user_email = Column(String, ForeignKey("users.email"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    size = Column(BigInteger, default=0)  # Bytes of the user's uploads created that day
+    uploads = Column(Integer, default=0)  # Number of the user's uploads created that day
+
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+    id = Column(String, primary_key=True, default=generate_uuid)
+    name = Column(String)
+    type = Column(String)
+    size = Column(BigInteger)  # Total size announced by the client
+    offset = Column(BigInteger, default=0)  # Bytes received so far
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)  # When the last chunk was received
+    lease = Column(String)  # Held by the request writing a chunk, see `upload_session_chunk`
+    owner_id = Column(String, ForeignKey("users.email"))
+    owner = relationship("User")
+
+
+class QuotaReservation(Base):
+    # Quota reserved by an upload that is streaming in, see `quota.UploadReservation`
+    __tablename__ = "quota_reservations"
+    id = Column(String, primary_key=True, default=generate_uuid)
+    owner_id = Column(String, ForeignKey("users.email"), index=True)
+    size = Column(BigInteger)  # Bytes reserved so far
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)  # Refreshed while the upload runs
+
 
 class History(Base):
     __tablename__ = "history"
@@ -86,10 +162,22 @@ class History(Base):
     user_email = Column(String, ForeignKey("users.email"))
     user = relationship("User", back_populates="history_entries")
 
+    __table_args__ = (
+        Index("ix_history_user_email_created_at", "user_email", "created_at"),
+    )
+
 
 def get_db():
+    get_engine()
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    get_async_engine()
+    async with AsyncSessionLocal() as db:
+        await checkout_connection(db)
+        yield db
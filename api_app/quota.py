@@ -0,0 +1,185 @@
+import time
+from datetime import datetime
+from fastapi.exceptions import HTTPException
+from sqlalchemy import delete, func, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from api_app import models
+from api_app.config import settings
+from api_app.metrics import quota_rejections
+
+
+# Quota is only ever changed with single UPDATE statements evaluated by the database,
+# never by writing back values read earlier, so concurrent requests cannot overwrite
+# each other's changes. `ck_users_space_within_quota` backs the conditions up.
+
+
+def _update_user(email: str):
+    return (
+        update(models.User)
+        .where(models.User.email == email)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def reserve_space(db: AsyncSession, email: str, size: int) -> bool:
+    """
+    Reserves `size` bytes of a user's quota if they fit next to the space already used and reserved.
+
+    The check and the reservation are one conditional UPDATE, so concurrent uploads of the
+    same user can never reserve more than the quota between them. It runs in the caller's
+    transaction, which records what holds the reservation and should be committed right
+    away so the user's row is only locked briefly.
+
+    Returns:
+        bool: False if the user does not have `size` bytes left.
+    """
+    result = await db.execute(
+        _update_user(email)
+        .where(models.User.space + models.User.reserved_space + size <= models.User.max_space)
+        .values(reserved_space=models.User.reserved_space + size)
+    )
+    return result.rowcount == 1
+
+
+async def release_space(db: AsyncSession, email: str, size: int):
+    """
+    Gives back space reserved by an upload that failed or was abandoned, in the caller's transaction.
+    """
+    await db.execute(
+        _update_user(email).values(reserved_space=models.User.reserved_space - size)
+    )
+
+
+async def charge_space(db: AsyncSession, email: str, size: int, reserved: int):
+    """
+    Turns a reservation of `reserved` bytes into `size` bytes of used space.
+
+    Runs in the caller's transaction so the space is charged together with the upload row.
+    Any part of the reservation the upload did not need is given back at the same time.
+    """
+    await db.execute(
+        _update_user(email).values(
+            space=models.User.space + size,
+            reserved_space=models.User.reserved_space - reserved,
+            version=models.User.version + 1,
+        )
+    )
+
+
+async def free_space(db: AsyncSession, email: str, size: int):
+    """
+    Gives back the space of a deleted upload, in the caller's transaction.
+
+    The result is clamped at zero so that space which has drifted below the size of the
+    user's uploads does not make the delete fail.
+    """
+    await db.execute(
+        _update_user(email).values(
+            space=func.greatest(models.User.space - size, 0),
+            version=models.User.version + 1,
+        )
+    )
+
+
+class UploadReservation:
+    """
+    Reserves quota for an upload of unknown size as its bytes arrive.
+
+    Space is reserved in extents of `QUOTA_RESERVATION_EXTENT` bytes, each in its own short
+    transaction, rather than locking the user's row for the whole upload. Once the upload
+    is saved the reservation is charged with `charge`; if anything fails it is handed back
+    with `release`.
+
+    The reservation is recorded in a `QuotaReservation` row, written with each extent and
+    refreshed while the upload streams in. If the worker dies before handing it back, the
+    reconciler releases it once it has gone `QUOTA_RESERVATION_TTL` seconds without a
+    refresh. Charging and releasing give back what the row still holds, so a reservation
+    expired by the reconciler is never given back twice.
+    """
+
+    def __init__(self, db: AsyncSession, email: str, extent: int = None):
+        self.db = db
+        self.email = email
+        self.extent = extent or settings.QUOTA_RESERVATION_EXTENT
+        self.id = models.generate_uuid()
+        self.reserved = 0
+        self._refreshed = 0.0
+
+    async def ensure(self, total: int):
+        """
+        Makes sure at least `total` bytes are reserved.
+
+        Raises:
+            HTTPException: If the user's quota cannot hold `total` bytes.
+        """
+        if total <= self.reserved:
+            await self._refresh()
+            return
+        missing = total - self.reserved
+        # Ask for a whole extent, or just what is missing when the quota is nearly used up
+        for size in (max(missing, self.extent), missing):
+            if await reserve_space(self.db, self.email, size):
+                now = datetime.utcnow()
+                await self.db.execute(
+                    insert(models.QuotaReservation)
+                    .values(id=self.id, owner_id=self.email, size=size, updated_at=now)
+                    .on_conflict_do_update(
+                        index_elements=[models.QuotaReservation.id],
+                        set_={"size": models.QuotaReservation.size + size, "updated_at": now},
+                    )
+                )
+                await self.db.commit()
+                self.reserved += size
+                self._refreshed = time.monotonic()
+                return
+            await self.db.rollback()
+        quota_rejections.inc()
+        raise HTTPException(
+            status_code=400, detail="Not enough space to upload file")
+
+    async def _refresh(self):
+        # Show the reconciler the upload is still running, a few times per TTL
+        if not self.reserved or time.monotonic() - self._refreshed < settings.QUOTA_RESERVATION_TTL / 4:
+            return
+        await self.db.execute(
+            update(models.QuotaReservation)
+            .where(models.QuotaReservation.id == self.id)
+            .values(updated_at=datetime.utcnow())
+        )
+        await self.db.commit()
+        self._refreshed = time.monotonic()
+
+    async def _take(self) -> int:
+        """
+        Deletes the reservation's row in the caller's transaction.
+
+        Returns:
+            int: The bytes the row held, or 0 if the reconciler has expired it.
+        """
+        result = await self.db.execute(
+            delete(models.QuotaReservation)
+            .where(models.QuotaReservation.id == self.id)
+            .returning(models.QuotaReservation.size)
+        )
+        return result.scalar_one_or_none() or 0
+
+    async def charge(self, size: int):
+        """
+        Charges `size` bytes in the caller's transaction and drops the rest of the reservation.
+
+        If that transaction is rolled back the reservation still stands and must be released.
+        """
+        await charge_space(self.db, self.email, size, await self._take())
+
+    async def release(self):
+        """
+        Hands the whole reservation back. Commits right away.
+        """
+        if not self.reserved:
+            return
+        self.reserved = 0
+        reserved = await self._take()
+        if reserved:
+            await release_space(self.db, self.email, reserved)
+        await self.db.commit()
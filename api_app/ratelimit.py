@@ -0,0 +1,127 @@
+import json
+import math
+import time
+from fastapi import HTTPException
+from api_app import Oauth2
+from api_app.cache import shared_cache
+from api_app.config import settings
+from api_app.metrics import Counter, registry
+
+
+rate_limited = registry.register(Counter(
+    "xendpal_rate_limited_total", "Requests refused with 429 because a rate limit was exceeded.",
+    ["limit"],
+))
+
+# (method, path) -> [(limit name, counted per "user" or "ip", setting holding the limit)]
+# Paths are matched literally: every limited route has no path parameters.
+RULES = {
+    ("POST", "/file/upload"): [
+        ("uploads", "user", "RATE_LIMIT_UPLOADS_PER_USER"),
+        ("uploads", "ip", "RATE_LIMIT_UPLOADS_PER_IP"),
+    ],
+    ("POST", "/file/upload-sessions"): [
+        ("uploads", "user", "RATE_LIMIT_UPLOADS_PER_USER"),
+        ("uploads", "ip", "RATE_LIMIT_UPLOADS_PER_IP"),
+    ],
+    ("POST", "/file/share-upload"): [
+        ("shares", "user", "RATE_LIMIT_SHARES_PER_USER"),
+        ("shares", "ip", "RATE_LIMIT_SHARES_PER_IP"),
+    ],
+    ("POST", "/file/share-upload/bulk"): [
+        ("shares", "user", "RATE_LIMIT_SHARES_PER_USER"),
+        ("shares", "ip", "RATE_LIMIT_SHARES_PER_IP"),
+    ],
+    ("POST", "/user/login/google"): [("logins", "ip", "RATE_LIMIT_LOGINS_PER_IP")],
+    ("POST", "/user/login/demo"): [("logins", "ip", "RATE_LIMIT_LOGINS_PER_IP")],
+    ("POST", "/user/refresh-token"): [("logins", "ip", "RATE_LIMIT_LOGINS_PER_IP")],
+}
+
+_INVALID_TOKEN = HTTPException(status_code=401)
+
+
+def _bearer_email(scope):
+    """
+    Returns the email of the request's access token, or None without a valid one.
+    """
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer" or not token:
+                return None
+            try:
+                return Oauth2.verified_email(token, _INVALID_TOKEN)
+            except HTTPException:
+                return None
+    return None
+
+
+def _client_ip(scope):
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class RateLimitMiddleware:
+    """
+    Counts the requests to the upload, share and login routes per user and per client IP,
+    and refuses them with 429 once a limit is reached within the current window.
+
+    The check runs before the endpoint reads the request body, so a refused upload costs
+    neither disk space nor a database query. Counters live in the shared store: with
+    Redis every worker and instance counts against the same limits; without it each
+    worker counts on its own. Requests without a valid token are only limited per IP,
+    and the endpoint refuses them anyway.
+
+    The IP is the one the ASGI server reports, so behind a proxy uvicorn must be started
+    with `--proxy-headers` and the proxy's address in `--forwarded-allow-ips`.
+    """
+
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = shared_cache if store is None else store
+
+    async def _exceeded(self, scope):
+        """
+        Counts the request against the limits of its route.
+
+        Returns:
+            tuple: The name of the first limit exceeded and the seconds until its window ends, or None.
+        """
+        window = settings.RATE_LIMIT_WINDOW
+        now = time.time()
+        index = int(now // window)
+        for name, kind, setting in RULES[(scope["method"], scope["path"])]:
+            limit = getattr(settings, setting)
+            if limit <= 0:
+                continue
+            identity = _bearer_email(scope) if kind == "user" else _client_ip(scope)
+            if identity is None:
+                continue
+            count = await self.store.incr(f"ratelimit:{name}:{kind}:{identity}:{index}", window)
+            if count > limit:
+                return f"{name}_per_{kind}", math.ceil((index + 1) * window - now)
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in RULES:
+            await self.app(scope, receive, send)
+            return
+
+        exceeded = await self._exceeded(scope)
+        if exceeded is None:
+            await self.app(scope, receive, send)
+            return
+
+        limit, retry_after = exceeded
+        rate_limited.inc(limit=limit)
+        body = json.dumps({"detail": "Too many requests, try again later"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(retry_after, 1)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
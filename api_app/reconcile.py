@@ -0,0 +1,453 @@
+"""
+Reconciles the database with the files under ``Uploads/``.
+
+The reconciler walks the tables and the upload folder in batches and reports
+
+- users whose ``space`` differs from the size of their uploads, or whose
+  ``reserved_space`` differs from the space held by their open upload sessions
+  and the uploads streaming in,
+- upload sessions without a chunk for ``UPLOAD_SESSION_TTL`` seconds and
+  reservations of streaming uploads not refreshed for ``QUOTA_RESERVATION_TTL``
+  seconds, left behind by abandoned uploads and workers that died,
+- shares and share recipients left behind by deleted uploads,
+- blobs whose reference count differs from the uploads pointing at them,
+- uploads whose content is missing from storage,
+- blobs in the storage backend and files on disk that no row refers to.
+
+Nothing is changed unless ``--fix`` is given, which also expires the stale upload
+sessions and reservations and gives their space back. Uploads whose file is
+missing are only deleted with ``--remove-missing``, since that removes them for
+their users.
+
+Every batch runs in its own short transaction, followed by a pause, so the
+reconciler can run next to live traffic. Fixes are compare-and-set updates that
+are skipped if a request changed the row in the meantime; the next run picks
+them up. Files younger than ``--grace`` seconds are ignored so uploads in
+progress are never mistaken for orphans.
+
+Usage::
+
+    python -m api_app.reconcile [--fix] [--remove-missing] [--batch-size 500]
+                                [--pause 0.05] [--grace 3600] [--every SECONDS]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import islice
+from pathlib import Path
+
+from sqlalchemy import delete, exists, func, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+
+from api_app import models, storage
+from api_app.backends import LocalBackend
+from api_app.config import settings
+from api_app.database import AsyncSessionLocal, get_async_engine
+from api_app.quota import release_space
+
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_FOLDER = Path("Uploads")
+
+
+def _missing_keys(backend, keys):
+    return {key for key in keys if not key or not backend.exists(key)}
+
+
+def _delete_keys(backend, keys):
+    for key in keys:
+        backend.delete(key)
+
+
+def _remove_files(paths):
+    for path in paths:
+        storage.discard_file(path)
+
+
+class Reconciler:
+    def __init__(
+        self,
+        fix: bool = False,
+        remove_missing: bool = False,
+        batch_size: int = 500,
+        pause: float = 0.05,
+        grace: float = 3600,
+    ):
+        self.fix = fix
+        self.remove_missing = remove_missing
+        self.batch_size = batch_size
+        self.pause = pause
+        self.grace = grace
+        self.counts = Counter()
+
+    def report(self, problem: str, detail: str):
+        self.counts[problem] += 1
+        logger.info("%s: %s", problem, detail)
+
+    async def walk(self, statement, *keys):
+        """
+        Runs `statement` one batch at a time using keyset pagination on `keys`.
+
+        Yields a session and the rows of each batch. Whatever the caller does with the
+        session is committed before the next batch is read.
+        """
+        last = None
+        while True:
+            batch = statement.order_by(*keys).limit(self.batch_size)
+            if last is not None:
+                batch = batch.where(tuple_(*keys) > tuple_(*last))
+
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(batch)).all()
+                if rows:
+                    yield db, rows
+                await db.commit()
+
+            if len(rows) < self.batch_size:
+                return
+            last = tuple(getattr(rows[-1], key.key) for key in keys)
+            await asyncio.sleep(self.pause)
+
+    async def run(self):
+        await self.expire(models.UploadSession, settings.UPLOAD_SESSION_TTL, "expired upload session")
+        await self.expire(models.QuotaReservation, settings.QUOTA_RESERVATION_TTL, "expired reservation")
+        await self.reconcile_space()
+        await self.sweep_shares()
+        await self.sweep_recipients()
+        await self.check_blobs()
+        await self.check_legacy_uploads()
+        await self.sweep_blobs()
+        await self.sweep_files()
+        return self.counts
+
+    async def reconcile_space(self):
+        User = models.User
+        used = (
+            select(func.coalesce(func.sum(models.Upload.size), 0))
+            .where(models.Upload.owner_id == User.email)
+            .scalar_subquery()
+        )
+        pending = (
+            select(func.coalesce(func.sum(models.UploadSession.size), 0))
+            .where(models.UploadSession.owner_id == User.email)
+            .scalar_subquery()
+        ) + (
+            select(func.coalesce(func.sum(models.QuotaReservation.size), 0))
+            .where(models.QuotaReservation.owner_id == User.email)
+            .scalar_subquery()
+        )
+        statement = select(
+            User.email, User.space, User.reserved_space, used.label("used"), pending.label("pending")
+        )
+
+        async for db, rows in self.walk(statement, User.email):
+            for row in rows:
+                if row.space != row.used:
+                    self.report("space drift", f"{row.email} has {row.space} bytes recorded, {row.used} uploaded")
+                    if self.fix:
+                        # Like the migration that added the quota constraint, a user who
+                        # already holds more than their quota keeps it
+                        await db.execute(
+                            update(User)
+                            .where(User.email == row.email, User.space == row.space)
+                            .values(
+                                space=row.used,
+                                max_space=func.greatest(User.max_space, row.used + User.reserved_space),
+                                version=User.version + 1,
+                            )
+                        )
+
+                if row.reserved_space != row.pending:
+                    self.report(
+                        "reservation drift",
+                        f"{row.email} has {row.reserved_space} bytes reserved, {row.pending} held by uploads",
+                    )
+                    # Every reservation is recorded in the transaction that makes it, so the
+                    # snapshot is consistent and the compare-and-set is safe next to uploads
+                    if self.fix:
+                        await db.execute(
+                            update(User)
+                            .where(User.email == row.email, User.reserved_space == row.reserved_space)
+                            .values(
+                                reserved_space=row.pending,
+                                max_space=func.greatest(User.max_space, User.space + row.pending),
+                                version=User.version + 1,
+                            )
+                        )
+
+    async def expire(self, model, ttl: float, problem: str):
+        """
+        Deletes the rows of `model` whose `updated_at` is more than `ttl` seconds old and
+        gives the space they hold back to their owners.
+
+        Rows locked by a request, such as a session receiving a chunk, are skipped. The
+        part files of expired upload sessions are removed once their rows are gone.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+        statement = select(model.id, model.owner_id, model.size).where(model.updated_at < cutoff)
+        parts = []
+
+        async for db, rows in self.walk(statement, model.id):
+            for row in rows:
+                self.report(problem, f"{row.id} of {row.owner_id}, holding {row.size} bytes")
+            if not self.fix:
+                continue
+
+            stale = (
+                select(model.id)
+                .where(model.id.in_([row.id for row in rows]), model.updated_at < cutoff)
+                .with_for_update(skip_locked=True)
+            )
+            expired = (await db.execute(
+                delete(model)
+                .where(model.id.in_(stale.scalar_subquery()))
+                .returning(model.id, model.owner_id, model.size)
+                .execution_options(synchronize_session=False)
+            )).all()
+            held = Counter()
+            for row in expired:
+                held[row.owner_id] += row.size
+            for email, size in held.items():
+                await release_space(db, email, size)
+            if model is models.UploadSession:
+                parts.extend(storage.session_part_path(row.id) for row in expired)
+
+        if parts:
+            await asyncio.to_thread(_remove_files, parts)
+
+    async def sweep_shares(self):
+        SharedUpload = models.SharedUpload
+        orphaned = or_(
+            SharedUpload.upload_id.is_(None),
+            ~exists().where(models.Upload.id == SharedUpload.upload_id),
+        )
+        statement = select(SharedUpload.id, orphaned.label("orphaned"))
+
+        async for db, rows in self.walk(statement, SharedUpload.id):
+            orphans = [row.id for row in rows if row.orphaned]
+            for share_id in orphans:
+                self.report("orphaned share", share_id)
+            if orphans and self.fix:
+                await db.execute(
+                    delete(models.SharedRecipient).where(models.SharedRecipient.shared_upload_id.in_(orphans))
+                )
+                await db.execute(delete(SharedUpload).where(SharedUpload.id.in_(orphans)))
+
+    async def sweep_recipients(self):
+        SharedRecipient = models.SharedRecipient
+        orphaned = or_(
+            SharedRecipient.shared_upload_id.is_(None),
+            ~exists().where(models.SharedUpload.id == SharedRecipient.shared_upload_id),
+        )
+        statement = select(SharedRecipient.id, orphaned.label("orphaned"))
+
+        async for db, rows in self.walk(statement, SharedRecipient.id):
+            orphans = [row.id for row in rows if row.orphaned]
+            for recipient_id in orphans:
+                self.report("orphaned share recipient", recipient_id)
+            if orphans and self.fix:
+                await db.execute(delete(SharedRecipient).where(SharedRecipient.id.in_(orphans)))
+
+    async def check_blobs(self):
+        Blob = models.Blob
+        references = (
+            select(func.count())
+            .where(models.Upload.blob_digest == Blob.digest)
+            .scalar_subquery()
+        )
+        statement = select(Blob.digest, Blob.ref_count, references.label("references"))
+
+        async for db, rows in self.walk(statement, Blob.digest):
+            missing = await asyncio.to_thread(
+                _missing_keys, storage.blob_backend, [row.digest for row in rows]
+            )
+            for row in rows:
+                if row.digest in missing and row.references:
+                    self.report("missing file", f"blob {row.digest} used by {row.references} uploads")
+                    if self.remove_missing:
+                        uploads = await db.execute(
+                            select(models.Upload).where(models.Upload.blob_digest == row.digest)
+                        )
+                        for upload in uploads.scalars():
+                            await storage.remove_upload(db, upload)
+                        continue
+
+                if row.ref_count != row.references:
+                    self.report(
+                        "blob reference drift",
+                        f"{row.digest} counts {row.ref_count} references, {row.references} uploads use it",
+                    )
+                    if not self.fix:
+                        continue
+                    if row.references:
+                        await db.execute(
+                            update(Blob)
+                            .where(Blob.digest == row.digest, Blob.ref_count == row.ref_count)
+                            .values(ref_count=row.references)
+                        )
+                    else:
+                        removed = await db.execute(
+                            delete(Blob)
+                            .where(Blob.digest == row.digest, Blob.ref_count == row.ref_count)
+                            .returning(Blob.digest)
+                        )
+                        await asyncio.to_thread(
+                            _delete_keys, storage.blob_backend, removed.scalars().all()
+                        )
+
+    async def check_legacy_uploads(self):
+        # Uploads stored before deduplication keep their own file under Uploads/<email>/
+        Upload = models.Upload
+        statement = select(Upload.id, Upload.path).where(Upload.blob_digest.is_(None))
+
+        async for db, rows in self.walk(statement, Upload.path, Upload.id):
+            missing = await asyncio.to_thread(
+                _missing_keys, storage.legacy_files, [row.path for row in rows]
+            )
+            for row in rows:
+                if row.path in missing:
+                    self.report("missing file", f"upload {row.id} at {row.path}")
+                    if self.remove_missing:
+                        await storage.remove_upload(db, await db.get(Upload, row.id))
+
+    async def sweep_blobs(self):
+        cutoff = time.time() - self.grace
+        keys = storage.blob_backend.iter_keys()
+
+        while batch := await asyncio.to_thread(list, islice(keys, self.batch_size)):
+            digests = [key for key, modified in batch if modified <= cutoff]
+            if digests:
+                async with AsyncSessionLocal() as db:
+                    known = set((await db.execute(
+                        select(models.Blob.digest).where(models.Blob.digest.in_(digests))
+                    )).scalars())
+
+                orphans = [digest for digest in digests if digest not in known]
+                for digest in orphans:
+                    self.report("orphaned blob", storage.blob_backend.location(digest))
+                if orphans and self.fix:
+                    await self.delete_orphaned_blobs(orphans)
+
+            await asyncio.sleep(self.pause)
+
+    async def delete_orphaned_blobs(self, digests):
+        """
+        Deletes blobs found without a row, unless an upload has started using them since.
+
+        Uploads only place a blob while holding its row, so an uncommitted placeholder row
+        is inserted for each digest and kept while the blobs are deleted. An upload of the
+        same content that committed in the meantime makes the insert skip its digest, and
+        one that starts now waits for the placeholders to be rolled back.
+        """
+        async with AsyncSessionLocal() as db:
+            locked = await db.execute(
+                insert(models.Blob)
+                .values([
+                    {"digest": digest, "path": storage.blob_backend.location(digest), "size": 0, "ref_count": 0}
+                    for digest in digests
+                ])
+                .on_conflict_do_nothing(index_elements=[models.Blob.digest])
+                .returning(models.Blob.digest)
+            )
+            await asyncio.to_thread(_delete_keys, storage.blob_backend, locked.scalars().all())
+            await db.rollback()
+
+    async def sweep_files(self):
+        # Staged files, upload session parts and the files of uploads stored before
+        # deduplication. Blobs kept on the local disk are checked by `sweep_blobs`.
+        cutoff = time.time() - self.grace
+        exclude = []
+        if isinstance(storage.blob_backend, LocalBackend):
+            exclude.append(os.path.relpath(storage.blob_backend.root, storage.legacy_files.root))
+        files = storage.legacy_files.iter_keys(str(UPLOAD_FOLDER), exclude)
+
+        while batch := await asyncio.to_thread(list, islice(files, self.batch_size)):
+            staged, parts, legacy = [], {}, []
+            for path, mtime in batch:
+                if mtime > cutoff:
+                    continue
+                location = Path(path)
+                if location.is_relative_to(storage.STAGING_FOLDER):
+                    # Staged files are moved or removed by the request that wrote them
+                    staged.append(path)
+                elif location.is_relative_to(storage.SESSION_FOLDER):
+                    parts[location.name[:-len(".part")]] = path
+                else:
+                    legacy.append(path)
+
+            async with AsyncSessionLocal() as db:
+                known_sessions = set((await db.execute(
+                    select(models.UploadSession.id).where(models.UploadSession.id.in_(parts))
+                )).scalars()) if parts else set()
+                known_paths = set((await db.execute(
+                    select(models.Upload.path).where(
+                        models.Upload.blob_digest.is_(None), models.Upload.path.in_(legacy)
+                    )
+                )).scalars()) if legacy else set()
+
+            orphans = (
+                staged
+                + [path for session_id, path in parts.items() if session_id not in known_sessions]
+                + [path for path in legacy if path not in known_paths]
+            )
+            for path in orphans:
+                self.report("orphaned file", path)
+            if orphans and self.fix:
+                await asyncio.to_thread(_delete_keys, storage.legacy_files, orphans)
+
+            await asyncio.sleep(self.pause)
+
+
+async def reconcile(every: float = None, **options):
+    """
+    Runs the reconciler once, or every `every` seconds until cancelled.
+    """
+    get_async_engine()
+    while True:
+        started = time.monotonic()
+        counts = await Reconciler(**options).run()
+        summary = ", ".join(f"{count} {problem}" for problem, count in sorted(counts.items()))
+        logger.info(
+            "Reconciliation finished in %.1fs: %s",
+            time.monotonic() - started,
+            summary or "no problems found",
+        )
+        if not every:
+            return counts
+        await asyncio.sleep(every)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--fix", action="store_true",
+                        help="fix space drift and reference counts, expire stale upload sessions and reservations, "
+                             "remove orphaned rows and files")
+    parser.add_argument("--remove-missing", action="store_true",
+                        help="delete uploads whose file is missing from disk")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows or files handled per transaction")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to wait between batches")
+    parser.add_argument("--grace", type=float, default=3600, help="ignore files modified more recently than this")
+    parser.add_argument("--every", type=float, help="keep running, starting a new pass every this many seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    counts = asyncio.run(reconcile(
+        every=args.every,
+        fix=args.fix,
+        remove_missing=args.remove_missing,
+        batch_size=args.batch_size,
+        pause=args.pause,
+        grace=args.grace,
+    ))
+    for problem, count in sorted(counts.items()):
+        print(f"{problem:<28} {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,164 +1,300 @@
-from datetime import datetime
-from api_app.Oauth2 import get_current_user
+import base64
+import json
+import time
+import zipfile
+from datetime import datetime, timedelta
+from typing import Optional
+from api_app.Oauth2 import get_current_user, invalidate_user
 from api_app import models, schema
-from api_app.models import get_db
-from sqlalchemy.orm import Session
-from fastapi import BackgroundTasks, Query, Request, status
+from api_app.models import get_async_db
+from sqlalchemy import delete, insert, or_, select, tuple_, union, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Query, Request, Response, status
 from fastapi.exceptions import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi import (
-    File,
-    UploadFile,
     Depends,
     APIRouter,
 )
-from pathlib import Path
-from api_app.extras import send_share_email
+from api_app.cache import shared_cache
+from api_app.config import settings
+from api_app.archives import bundle_member_names, get_zip_index, iter_zip_bundle, zip_member_response
+from api_app.downloads import backend_download_response
+from api_app.extras import send_share_email, send_share_emails
+from api_app.mailer import mailer
+from api_app import storage
+from api_app.storage import stream_upload_to_staging
+from api_app.metrics import quota_rejections
+from api_app.quota import UploadReservation, charge_space, release_space, reserve_space
+from api_app.usage import record_usage
+from api_app.versions import bump_versions, get_version, not_modified, user_etag
 import os
-from fastapi import UploadFile, File
-from pathlib import Path
 from sqlalchemy.orm import aliased
-from sqlalchemy.exc import SQLAlchemyError
-from werkzeug.utils import secure_filename
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
 
 
 router = APIRouter(
     prefix="/file",
     tags={"File": "this is the route concerned with file  upload and group assigning"},
 )
+
+
+def secure_filename(filename: str) -> str:
+    # werkzeug is only used for this, so it is imported on the first upload rather than at startup
+    from werkzeug.utils import secure_filename as werkzeug_secure_filename
+
+    return werkzeug_secure_filename(filename)
+
+
 frontend_url = "https://xendpal.vercel.app"
 backend_url = "https://xendpal-api.onrender.com/"
 
+# PostgreSQL's error code for a row lock that NOWAIT could not take
+LOCK_NOT_AVAILABLE = "55P03"
+
 
-@router.post("/upload")
+UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "properties": {"file": {"type": "string", "format": "binary"}},
+                "required": ["file"],
+            }
+        }
+    },
+}
+
+
+@router.post(
+    "/upload",
+    response_model=schema.UploadModelSchema,
+    openapi_extra={"requestBody": UPLOAD_REQUEST_BODY},
+)
 async def upload_file(
     request: Request,
     file_type: str = Query(...),
-    file: UploadFile = File(...),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Handles the uploading of files.
 
+    The file is sent as the `file` field of a multipart form. The body is parsed as it
+    arrives rather than spooled first, so the ZIP signature and the quota are checked on
+    the first bytes, and the file is written to disk once.
+
     Args:
-        request (Request): The HTTP request object.
+        request (Request): The HTTP request object, whose body holds the file.
         file_type (str): The type of the file being uploaded.
-        file (UploadFile): The file to be uploaded.
         current_user (models.User): The current user making the request.
-        db (Session): The database session.
+        db (AsyncSession): The database session.
 
     Raises:
-        HTTPException: If the file is not a ZIP archive or there is not enough space to upload the file.
+        HTTPException: If the body has no file, the file is not a ZIP archive or there is not enough space to upload the file.
         HTTPException: If there is a database error.
 
     Returns:
         dict: The details of the uploaded file.
     """
-    upload_folder = Path(f"Uploads/{current_user.email}")
-    upload_folder.mkdir(exist_ok=True)
+    # Don't hold a pooled connection while the file is received; the reservations below
+    # each check one out for a short transaction
+    await db.close()
 
-    file_content = await file.read()
+    # Reserve the space as the file arrives, so concurrent uploads of the same user can't
+    # go over the quota together
+    reservation = UploadReservation(db, current_user.email)
+    file = storage.MultipartFile(request)
 
-    # Check if the file is a ZIP by reading its signature
-    if file_content[:4] != b"PK\x03\x04":
-        raise HTTPException(
-            status_code=400, detail="File must be a ZIP archive")
+    try:
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit():
+            # Refuse a body that can't fit before reading any of it
+            await reservation.ensure(max(int(content_length) - storage.MULTIPART_OVERHEAD, 0))
 
-    # Get the size of the uploaded file
-    file_size_bytes = len(file_content)
+        # Stream the file to a staging area, checking the ZIP signature and the space left
+        # as it arrives, and hash it so identical content is only stored once
+        staged_location, file_size_bytes, digest = await stream_upload_to_staging(
+            file.chunks(), reservation.ensure)
+    except Exception:
+        await reservation.release()
+        raise
 
-    remaining_space_bytes = current_user.max_space - current_user.space
+    created = False
+    try:
+        blob_location, created = await storage.add_blob_reference(db, digest, file_size_bytes)
+        # Store the content before the row referencing it is committed
+        await run_in_threadpool(storage.place_blob, staged_location, digest, created)
 
-    if int(file_size_bytes) > int(remaining_space_bytes):
-        raise HTTPException(
-            status_code=400, detail="Not enough space to upload file")
+        new_file = models.Upload(
+            name=str(secure_filename(file.filename)),
+            path=blob_location,
+            type=str(file_type) if file_type else "unknown",
+            created_at=datetime.utcnow(),
+            size=file_size_bytes,
+            owner_id=current_user.email,
+            blob_digest=digest,
+        )
+
+        # Update the user's usage and charge the reserved space
+        await record_usage(db, current_user.email, new_file.created_at.date(), file_size_bytes, 1)
+        await reservation.charge(file_size_bytes)
+
+        # Save the new file to the database
+        db.add(new_file)
+        await db.commit()
+    except Exception as e:
+        await run_in_threadpool(storage.unplace_blob, digest, created)
+        await db.rollback()
+        await reservation.release()
+        await run_in_threadpool(storage.discard_file, staged_location)
+        if isinstance(e, SQLAlchemyError):
+            raise HTTPException(status_code=500, detail=str(e))
+        raise
 
-    filename = secure_filename(file.filename)
+    await invalidate_user(current_user.email)
 
-    file_location = upload_folder / filename
+    # Return the new files' details
+    return new_file
 
-    with file_location.open("wb") as buffer:
-        buffer.write(file_content)
 
-    file_size_bytes = os.path.getsize(file_location)
+def encode_cursor(upload: models.Upload) -> str:
+    raw = f"{upload.created_at.isoformat()}|{upload.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
-    new_file = models.Upload(
-        name=str(secure_filename(file.filename)),
-        path=str(file_location),
-        type=str(file_type) if file_type else "unknown",
-        size=file_size_bytes,
-        owner_id=current_user.email,
-    )
 
+def decode_cursor(cursor: str):
     try:
-        # Update the user's space
-        current_user.space += file_size_bytes
+        created_at, upload_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), upload_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-        # Save the new file to the database
-        db.add(new_file)
-        db.commit()
-    except SQLAlchemyError as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    # Return the new files' details
-    return new_file
+
+def user_items_statement(email: str, limit: int, cursor=None, file_type: str = None):
+    """
+    Builds the query for one page of the uploads a user owns or has been shared, newest first.
+
+    Both halves of the union are ordered on `(created_at, id)` and limited on their own, so the
+    cost of a page depends on its size rather than on the number of uploads the user has.
+    """
+    # Query for owned uploads
+    owned_uploads = select(models.Upload).where(models.Upload.owner_id == email)
+
+    # Query for shared uploads
+    shared_uploads = (
+        select(models.Upload)
+        .join(models.SharedUpload, models.Upload.id == models.SharedUpload.upload_id)
+        .join(
+            models.SharedRecipient,
+            models.SharedUpload.id == models.SharedRecipient.shared_upload_id,
+        )
+        .where(models.SharedRecipient.recipient_email == email)
+        .distinct()
+    )
+
+    branches = []
+    for branch in (owned_uploads, shared_uploads):
+        if file_type:
+            branch = branch.where(models.Upload.type == file_type)
+        if cursor:
+            branch = branch.where(
+                tuple_(models.Upload.created_at, models.Upload.id) < tuple_(*cursor)
+            )
+        branches.append(
+            branch.order_by(models.Upload.created_at.desc(), models.Upload.id.desc()).limit(limit)
+        )
+
+    # Combine the queries
+    combined = union(*branches).subquery()
+    upload = aliased(models.Upload, combined)
+    return select(upload).order_by(upload.created_at.desc(), upload.id.desc()).limit(limit)
 
 
 @router.get("/user_items")
 async def get_user_content(
     request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+    file_type: Optional[str] = Query(None, alias="type"),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
-    Retrieves the content owned by a user.
+    Retrieves a page of the content owned by or shared with a user, newest first.
+
+    The page is tagged with the user's version. A poll sending the tag back in
+    `If-None-Match` is answered with 304 before the listing is queried. Rendered pages
+    are kept in the shared cache under their tag, so any worker can serve a page again
+    without a query until the user's version changes.
 
     Args:
         request (Request): The request object from FastAPI.
+        response (Response): The response the ETag is set on.
+        limit (int): The maximum number of files to return, up to 200.
+        cursor (str, optional): The `next_cursor` returned by the previous page.
+        file_type (str, optional): Only return uploads of this type.
         current_user (User): The current user object obtained from the `get_current_user` dependency.
-        db (Session): The database session obtained from the `get_db` dependency.
+        db (AsyncSession): The database session obtained from the `get_async_db` dependency.
 
-    Returns:
-        Upload: The details of the newly saved file.
+    Raises:
+        HTTPException: If the cursor is invalid.
 
+    Returns:
+        Response: The JSON encoded files of the page and the cursor of the next page, which is None on the last page.
     """
-    # Query for owned uploads
-    owned_uploads = (
-        db.query(models.Upload)
-        .filter(models.Upload.owner_id == current_user.email)
-        .order_by(models.Upload.created_at.desc())
-    )
+    position = decode_cursor(cursor) if cursor else None
 
-    # Query for shared uploads
-    shared_uploads = (
-        db.query(models.Upload)
-        .join(models.SharedUpload, models.Upload.id == models.SharedUpload.upload_id)
-        .join(
-            models.SharedRecipient,
-            models.SharedUpload.id == models.SharedRecipient.shared_upload_id,
+    version = await get_version(db, current_user.email)
+    etag = user_etag(current_user.email, version, "user_items", limit, cursor, file_type)
+    unchanged = not_modified(request, response, etag)
+    if unchanged:
+        return unchanged
+
+    page = await shared_cache.get(f"user_items:{etag}")
+    if page is None:
+        # Fetch one extra row to know whether there is a next page
+        result = await db.execute(
+            user_items_statement(current_user.email, limit + 1, position, file_type)
         )
-        .filter(models.SharedRecipient.recipient_email == current_user.email)
-        .order_by(models.Upload.created_at.desc())
-    )
+        user_files = result.scalars().all()
+        next_cursor = encode_cursor(user_files[limit - 1]) if len(user_files) > limit else None
 
-    # Combine the queries
-    user_files = owned_uploads.union(shared_uploads).all()
+        # Serialize the files and folders into a response format
+        page = json.dumps(jsonable_encoder({
+            "files": [schema.UploadModelSchema.from_orm(file) for file in user_files[:limit]],
+            "next_cursor": next_cursor,
+        }), separators=(",", ":")).encode()
+        await shared_cache.set(f"user_items:{etag}", page, settings.LISTING_CACHE_TTL)
 
-    # Serialize the files and folders into a response format
-    response = {
-        "files": [schema.UploadModelSchema.from_orm(file) for file in user_files],
-    }
+    return Response(page, media_type="application/json", headers=response.headers)
 
-    return response
+
+def share_template_data(upload_names, sender_email, recipient_email, description):
+    # The file link opens the app, where the recipient signs in and finds the share:
+    # /file/download needs a bearer token, which a link in an email can't carry
+    return {
+        "reciepient_email": recipient_email,
+        "user_email": sender_email,
+        "description": description,
+        "file_path": f"{frontend_url}",
+        "file_names": upload_names,
+        "current_year": datetime.now().year,
+        "frontend_url": f"{frontend_url}",
+        "subject": "Xendpal File Share",
+    }
 
 
 @router.post("/share-upload")
 async def share_upload(
     request: Request,
     share_request: schema.ShareUploadSchema,
-    background_tasks: BackgroundTasks = BackgroundTasks(),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Handles the sharing of file uploads.
@@ -166,9 +302,8 @@ async def share_upload(
     Args:
         request (Request): The request object containing information about the HTTP request.
         share_request (schema.ShareUploadSchema): The share request schema containing the details of the upload to be shared.
-        background_tasks (BackgroundTasks, optional): The background tasks object used to run tasks asynchronously. Defaults to BackgroundTasks().
         current_user (models.User, optional): The current user object obtained from the `get_current_user` dependency. Defaults to Depends(get_current_user).
-        db (Session, optional): The database session object obtained from the `get_db` dependency. Defaults to Depends(get_db).
+        db (AsyncSession, optional): The database session object obtained from the `get_async_db` dependency. Defaults to Depends(get_async_db).
 
     Raises:
         HTTPException: If the upload specified in the share request does not exist or does not belong to the current user.
@@ -177,11 +312,7 @@ async def share_upload(
         200: A 200 status code indication that all went well
     """
     # Find the upload by ID
-    upload = (
-        db.query(models.Upload)
-        .filter(models.Upload.id == share_request.upload_id)
-        .first()
-    )
+    upload = await db.get(models.Upload, share_request.upload_id)
     if not upload or upload.owner_id != current_user.email:
         raise HTTPException(status_code=404, detail="Upload not found")
 
@@ -198,44 +329,370 @@ async def share_upload(
         recipient_email=share_request.recipient_email,
     )
 
-    template_data = {
-        "reciepient_email": share_request.recipient_email,
-        "user_email": current_user.email,
-        "description": share_request.description,
-        "file_path": f"{backend_url}/{upload.path}",
-        "file_name": upload.name,
-        "current_year": datetime.now().year,
-        "frontend_url": f"{frontend_url}",
-        "subject": "Xendpal File Share",
-    }
+    template_data = share_template_data(
+        [upload.name], current_user.email,
+        share_request.recipient_email, share_request.description,
+    )
     email = share_request.recipient_email
     subject = "Xendpal File Share"
     template_data = template_data
-    background_tasks.add_task(send_share_email, email, subject, template_data)
+    # Create a new history entry
+    new_history_entry = models.History(
+        message=f"Your file share - {upload.name} - to {share_request.recipient_email} was successful",
+        user_email=current_user.email,
+        created_at=datetime.utcnow(),
+    )
     try:
+        # The share, its history entry and the version bump are committed together, so
+        # a poll never caches the new version without the history entry
         db.add(shared_upload)
         db.add(shared_recipient)
-        db.commit()
-        # Create a new history entry
-        new_history_entry = models.History(
-            message=f"Your file share - {upload.name} - to {share_request.recipient_email} was successful",
-            user_email=current_user.email,
-            created_at=datetime.utcnow(),
-        )
         db.add(new_history_entry)
-        db.commit()
+        await bump_versions(db, [current_user.email, share_request.recipient_email])
+        await db.commit()
+        # Queued for the mailer's workers once the share is saved
+        send_share_email(email, subject, template_data)
         return status.HTTP_200_OK
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/share-upload/bulk", response_model=schema.BulkShareResultSchema)
+async def bulk_share_upload(
+    share_request: schema.BulkShareUploadSchema,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Shares several uploads with several recipients at once.
+
+    Ownership of every upload is checked with a single query, then the shares,
+    their recipients and the history entries are written with one bulk insert
+    each, in a single transaction. Every upload gets one share record listing
+    all the recipients. Each recipient gets one email listing all the uploads,
+    queued for the mailer as one batch after the transaction is committed.
+
+    Args:
+        share_request (schema.BulkShareUploadSchema): The uploads to share and who to share them with.
+        current_user (models.User, optional): The current user object obtained from the `get_current_user` dependency. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): The database session object obtained from the `get_async_db` dependency. Defaults to Depends(get_async_db).
+
+    Raises:
+        HTTPException: If any of the uploads does not exist or does not belong to the current user.
+        HTTPException: If the mail queue cannot take an email for every recipient right now.
+
+    Returns:
+        schema.BulkShareResultSchema: How many uploads, recipients and shares were recorded and how many emails were queued.
+    """
+    upload_ids = list(dict.fromkeys(share_request.upload_ids))
+    recipient_emails = list(dict.fromkeys(share_request.recipient_emails))
+
+    result = await db.execute(
+        select(models.Upload.id, models.Upload.name).where(
+            models.Upload.id.in_(upload_ids),
+            models.Upload.owner_id == current_user.email,
+        )
+    )
+    upload_names = dict(result.all())
+    missing = [upload_id for upload_id in upload_ids if upload_id not in upload_names]
+    if missing:
+        raise HTTPException(
+            status_code=404, detail=f"Upload not found: {', '.join(missing)}")
+
+    # Refuse rather than record shares whose notifications would be dropped
+    if mailer.room() < len(recipient_emails):
+        raise HTTPException(
+            status_code=503,
+            detail="Too many emails are waiting to be sent, try again later",
+            headers={"Retry-After": "60"},
+        )
+
+    now = datetime.utcnow()
+    shared_uploads, shared_recipients, history_entries = [], [], []
+    for upload_id in upload_ids:
+        shared_upload_id = models.generate_uuid()
+        shared_uploads.append({
+            "id": shared_upload_id,
+            "upload_id": upload_id,
+            "time_shared": now,
+            "permission": share_request.permission,
+            "description": share_request.description,
+        })
+        for recipient_email in recipient_emails:
+            shared_recipients.append({
+                "id": models.generate_uuid(),
+                "shared_upload_id": shared_upload_id,
+                "recipient_email": recipient_email,
+                "upload_id": upload_id,
+            })
+            history_entries.append({
+                "id": models.generate_uuid(),
+                "message": f"Your file share - {upload_names[upload_id]} - to {recipient_email} was successful",
+                "user_email": current_user.email,
+                "created_at": now,
+            })
+
+    names = [upload_names[upload_id] for upload_id in upload_ids]
+    emails = [
+        (
+            recipient_email,
+            "Xendpal File Share",
+            share_template_data(names, current_user.email, recipient_email, share_request.description),
+        )
+        for recipient_email in recipient_emails
+    ]
+
+    try:
+        await db.execute(insert(models.SharedUpload), shared_uploads)
+        await db.execute(insert(models.SharedRecipient), shared_recipients)
+        await db.execute(insert(models.History), history_entries)
+        await bump_versions(db, [current_user.email, *recipient_emails])
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "uploads": len(upload_ids),
+        "recipients": len(recipient_emails),
+        "shares": len(shared_recipients),
+        "emails_queued": send_share_emails(emails),
+    }
+
+
+def accessible_to(email: str):
+    """
+    Returns the condition matching the uploads a user owns or has been shared.
+    """
+    shared_with_user = (
+        select(models.SharedRecipient.id)
+        .join(
+            models.SharedUpload,
+            models.SharedUpload.id == models.SharedRecipient.shared_upload_id,
+        )
+        .where(
+            models.SharedUpload.upload_id == models.Upload.id,
+            models.SharedRecipient.recipient_email == email,
+        )
+        .exists()
+    )
+    return or_(models.Upload.owner_id == email, shared_with_user)
+
+
+async def get_accessible_upload(db: AsyncSession, upload_id: str, current_user: models.User):
+    """
+    Returns an upload if the current user owns it or it has been shared with them.
+
+    Raises:
+        HTTPException: If the upload does not exist or the user may not access it.
+    """
+    result = await db.execute(
+        select(models.Upload).where(
+            models.Upload.id == upload_id, accessible_to(current_user.email)
+        )
+    )
+    upload = result.scalars().first()
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+@router.api_route("/download/{upload_id}", methods=["GET", "HEAD"])
+async def download_upload(
+    request: Request,
+    upload_id: str,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Downloads an upload owned by or shared with the current user.
+
+    Supports `Range` requests (`206 Partial Content`) for resumable and parallel downloads,
+    and `If-None-Match` against a strong ETag derived from the content digest (`304 Not Modified`).
+
+    Args:
+        request (Request): The HTTP request object.
+        upload_id (str): The ID of the upload to download.
+        current_user (models.User): The current user making the request.
+        db (AsyncSession): The database session.
+
+    Raises:
+        HTTPException: If the upload does not exist, may not be accessed, or its file is missing.
+
+    Returns:
+        Response: The file, the requested part of it, or an empty `304`/`416` response.
+    """
+    upload = await get_accessible_upload(db, upload_id, current_user)
+
+    # Give the connection back to the pool before the transfer starts
+    await db.close()
+
+    try:
+        if upload.blob_digest:
+            etag = f'"{upload.blob_digest}"'
+        else:
+            # Uploads stored before deduplication have no digest to derive a strong ETag from
+            stat = await run_in_threadpool(os.stat, upload.path)
+            etag = f'W/"{int(stat.st_mtime)}-{stat.st_size}"'
+        backend, key = storage.upload_location(upload)
+        return await backend_download_response(request, backend, key, etag, upload.name)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+
+@router.get("/{upload_id}/entries")
+async def list_upload_entries(
+    upload_id: str,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Lists the files inside an upload without extracting or downloading it.
+
+    Only the central directory at the end of the archive is read, and the parsed index
+    is cached, so listing a multi-gigabyte archive again takes milliseconds.
+
+    Args:
+        upload_id (str): The ID of the upload, owned by or shared with the current user.
+        current_user (models.User): The current user making the request.
+        db (AsyncSession): The database session.
+
+    Raises:
+        HTTPException: If the upload does not exist, may not be accessed, its file is missing,
+            or it is not a readable ZIP archive.
+
+    Returns:
+        list: One object per entry with its `name`, `size`, `compressed_size`, `crc`,
+        `modified` time and whether it `is_dir`.
+    """
+    upload = await get_accessible_upload(db, upload_id, current_user)
+    await db.close()
+
+    try:
+        backend, key = storage.upload_location(upload)
+        index = await run_in_threadpool(get_zip_index, backend, key, upload.blob_digest)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=422, detail="Upload is not a readable ZIP archive")
+
+    return Response(content=index.json, media_type="application/json")
+
+
+@router.get("/{upload_id}/entries/{entry_name:path}")
+async def download_upload_entry(
+    request: Request,
+    upload_id: str,
+    entry_name: str,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Downloads a single file out of an upload without sending the rest of the archive.
+
+    The entry is located through the cached central directory index, and only its own
+    bytes are read. Stored entries are sent as they are and support `Range` requests;
+    compressed entries are decompressed as they stream.
+
+    Args:
+        request (Request): The HTTP request object.
+        upload_id (str): The ID of the upload, owned by or shared with the current user.
+        entry_name (str): The full name of the entry, as returned by `/file/{upload_id}/entries`.
+        current_user (models.User): The current user making the request.
+        db (AsyncSession): The database session.
+
+    Raises:
+        HTTPException: If the upload or the entry does not exist or may not be accessed,
+            if the entry is a directory or encrypted, or if the archive is damaged.
+
+    Returns:
+        Response: The content of the entry.
+    """
+    upload = await get_accessible_upload(db, upload_id, current_user)
+    await db.close()
+
+    try:
+        backend, key = storage.upload_location(upload)
+        index = await run_in_threadpool(get_zip_index, backend, key, upload.blob_digest)
+        entry = index.by_name.get(entry_name)
+        if entry is None or entry.is_dir:
+            raise HTTPException(status_code=404, detail="Entry not found")
+        if entry.encrypted:
+            raise HTTPException(status_code=422, detail="Entry is encrypted")
+
+        etag = f'"{upload.blob_digest}-{entry.crc:08x}"' if upload.blob_digest else None
+        return await zip_member_response(request, backend, key, entry, etag)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=422, detail="Upload is not a readable ZIP archive")
+
+
+@router.post("/bundle")
+async def download_bundle(
+    bundle_request: schema.BundleRequestSchema,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Downloads several uploads at once, as a single ZIP archive built while it is sent.
+
+    The uploads are stored in the archive as they are, in the order requested, without
+    temporary files. The archive is produced only as fast as the client reads it, and
+    memory use does not depend on its size.
+
+    Args:
+        bundle_request (schema.BundleRequestSchema): The IDs of the uploads to include.
+        current_user (models.User): The current user making the request.
+        db (AsyncSession): The database session.
+
+    Raises:
+        HTTPException: If any of the uploads does not exist, may not be accessed, or its file is missing.
+
+    Returns:
+        StreamingResponse: The ZIP archive.
+    """
+    upload_ids = list(dict.fromkeys(bundle_request.upload_ids))
+    result = await db.execute(
+        select(models.Upload).where(
+            models.Upload.id.in_(upload_ids), accessible_to(current_user.email)
+        )
+    )
+    uploads = {upload.id: upload for upload in result.scalars()}
+    await db.close()
+
+    missing = [upload_id for upload_id in upload_ids if upload_id not in uploads]
+    if missing:
+        raise HTTPException(
+            status_code=404, detail=f"Upload not found: {', '.join(missing)}")
+
+    uploads = [uploads[upload_id] for upload_id in upload_ids]
+    locations = [storage.upload_location(upload) for upload in uploads]
+    try:
+        # Sizes come from the stored objects themselves, which is what ends up in the archive
+        sizes = [await run_in_threadpool(backend.size, key) for backend, key in locations]
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    names = bundle_member_names([upload.name or upload.id for upload in uploads])
+    members = [
+        (name, backend, key, upload.created_at or datetime.utcnow(), size)
+        for name, upload, (backend, key), size in zip(names, uploads, locations, sizes)
+    ]
+    return StreamingResponse(
+        iter_zip_bundle(members),
+        media_type="application/zip",
+        headers={"content-disposition": 'attachment; filename="xendpal-bundle.zip"'},
+    )
+
+
 @router.delete("/delete_upload/{upload_id}")
 async def delete_upload(
     request: Request,
     upload_id: str,
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Deletes an uploaded file and its corresponding database record, given the upload ID and the authenticated user's credentials.
@@ -255,29 +712,405 @@ async def delete_upload(
     """
     
     # Find the upload by ID
-    upload = db.query(models.Upload).filter(
-        models.Upload.id == upload_id).first()
+    upload = await db.get(models.Upload, upload_id)
     if not upload or upload.owner_id != current_user.email:
         raise HTTPException(status_code=404, detail="Upload not found")
 
-    user_folder_path = Path("Uploads") / current_user.email
-    file_path = user_folder_path / upload.name
+    try:
+        # Delete the upload and its shares, giving back its space and blob reference
+        await storage.remove_upload(db, upload)
+        await db.commit()
+        await invalidate_user(current_user.email)
+
+        # Uploads stored before deduplication live in the user's own folder
+        if not upload.blob_digest and upload.path:
+            await run_in_threadpool(storage.legacy_files.delete, upload.path)
+
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
 
+    return status.HTTP_204_NO_CONTENT
+
+
+async def get_upload_session(db: AsyncSession, session_id: str, current_user: models.User):
+    upload_session = await db.get(models.UploadSession, session_id)
+    if not upload_session or upload_session.owner_id != current_user.email:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return upload_session
+
+
+async def lock_upload_session(db: AsyncSession, session_id: str, current_user: models.User):
+    """
+    Reads an upload session and locks its row until the transaction ends.
+
+    The lock is taken with NOWAIT, so a request racing another one for the same session
+    is refused straight away instead of queueing behind it.
+
+    Raises:
+        HTTPException: If the session does not exist or does not belong to the current user,
+            or 409 if another request holds the lock.
+    """
     try:
-        # Delete the upload from the database
-        db.delete(upload)
+        result = await db.execute(
+            select(models.UploadSession)
+            .where(models.UploadSession.id == session_id)
+            .with_for_update(nowait=True)
+            .execution_options(populate_existing=True)
+        )
+    except DBAPIError as e:
+        await db.rollback()
+        if getattr(e.orig, "pgcode", None) == LOCK_NOT_AVAILABLE:
+            raise HTTPException(
+                status_code=409, detail="Another request is using this upload session")
+        raise
+    upload_session = result.scalars().first()
+    if not upload_session or upload_session.owner_id != current_user.email:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return upload_session
 
-        # Update the user's space
-        current_user.space -= upload.size
-        db.add(current_user)
-        db.commit()
 
-        # Delete the specific file from the file system
-        if file_path.exists():
-            os.remove(file_path)
+def chunk_lease_held(upload_session: models.UploadSession) -> bool:
+    """
+    Tells whether a chunk is being written to an upload session.
 
+    A lease that has gone `UPLOAD_CHUNK_LEASE_TTL` seconds without a refresh belongs to a
+    client that stopped sending, or a worker that died, and no longer counts.
+    """
+    if upload_session.lease is None:
+        return False
+    lapsed = datetime.utcnow() - timedelta(seconds=settings.UPLOAD_CHUNK_LEASE_TTL)
+    return upload_session.updated_at > lapsed
+
+
+async def update_chunk_lease(
+    db: AsyncSession, session_id: str, lease: str, end: bool = False, offset: int = None,
+) -> bool:
+    """
+    Refreshes a chunk lease, or ends it if `end` is set, and commits.
+
+    Args:
+        offset (int): The new offset of the session, recorded with the lease.
+
+    Returns:
+        bool: False if the lease was lost, i.e. the session was removed or taken over by another request.
+    """
+    values = {"updated_at": datetime.utcnow()}
+    if end:
+        values["lease"] = None
+    if offset is not None:
+        values["offset"] = offset
+    result = await db.execute(
+        update(models.UploadSession)
+        .where(models.UploadSession.id == session_id, models.UploadSession.lease == lease)
+        .values(values)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def leased_stream(db: AsyncSession, session_id: str, lease: str, stream):
+    """
+    Passes a chunk's body through, refreshing its lease a few times per TTL as data arrives.
+
+    Raises:
+        HTTPException: 409 if the lease was lost while the chunk was being received.
+    """
+    refreshed = time.monotonic()
+    async for data in stream:
+        if time.monotonic() - refreshed >= settings.UPLOAD_CHUNK_LEASE_TTL / 4:
+            if not await update_chunk_lease(db, session_id, lease):
+                raise HTTPException(
+                    status_code=409, detail="The upload session was taken over by another request")
+            refreshed = time.monotonic()
+        yield data
+
+
+@router.post("/upload-sessions", response_model=schema.UploadSessionSchema)
+async def create_upload_session(
+    session_request: schema.UploadSessionCreate,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Starts a resumable upload. The file is then sent in chunks with `PUT /file/upload-sessions/{session_id}`
+    and completed with `POST /file/upload-sessions/{session_id}/finalize`.
+
+    A session that receives no chunk for `UPLOAD_SESSION_TTL` seconds is expired by the reconciler,
+    which gives its space back.
+
+    Args:
+        session_request (schema.UploadSessionCreate): The name, type and total size of the file to upload.
+        current_user (models.User): The current user making the request.
+        db (AsyncSession): The database session.
+
+    Raises:
+        HTTPException: If the announced size is invalid or there is not enough space to upload the file.
+
+    Returns:
+        schema.UploadSessionSchema: The new upload session, starting at offset 0.
+    """
+    if session_request.size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive")
+
+    upload_session = models.UploadSession(
+        name=secure_filename(session_request.name),
+        type=session_request.file_type or "unknown",
+        size=session_request.size,
+        offset=0,
+        owner_id=current_user.email,
+    )
+
+    try:
+        # The whole file is reserved now, in the transaction creating the session that holds
+        # the reservation, and charged when the session is finalized
+        reserved = await reserve_space(db, current_user.email, session_request.size)
+        if reserved:
+            db.add(upload_session)
+            await db.commit()
+        else:
+            await db.rollback()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not reserved:
+        quota_rejections.inc()
+        raise HTTPException(
+            status_code=400, detail="Not enough space to upload file")
+
+    await run_in_threadpool(storage.create_session_part, upload_session.id)
+
+    return upload_session
+
+
+@router.get("/upload-sessions/{session_id}", response_model=schema.UploadSessionSchema)
+async def get_upload_session_status(
+    session_id: str,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Returns an upload session, including the offset the next chunk has to start at.
+
+    Raises:
+        HTTPException: If the session does not exist or does not belong to the current user.
+    """
+    return await get_upload_session(db, session_id, current_user)
+
+
+@router.put("/upload-sessions/{session_id}", response_model=schema.UploadSessionSchema)
+async def upload_session_chunk(
+    request: Request,
+    session_id: str,
+    offset: int = Query(...),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Appends the raw request body to an upload session.
+
+    `offset` must match the current offset of the session. If the connection drops while the chunk
+    is being sent, the bytes received so far are kept and the session offset reflects them.
+
+    Before the body is read, the request takes the session's chunk lease in a short transaction
+    and gives its pooled connection back, so a slow client holds neither a connection nor a row
+    lock while its chunk arrives. A second request for the same session is refused with 409 while
+    the lease is held, instead of writing to the part file at the same time. The lease is refreshed
+    as data arrives and lapses after `UPLOAD_CHUNK_LEASE_TTL` seconds without any.
+
+    Args:
+        request (Request): The HTTP request whose body is the chunk.
+        session_id (str): The ID of the upload session.
+        offset (int): The position of the chunk in the file.
+        current_user (models.User): The current user making the request.
+        db (AsyncSession): The database session.
+
+    Raises:
+        HTTPException: If the session does not exist, or 409 if `offset` is not the current offset,
+            another chunk is being written or the lease was lost.
+
+    Returns:
+        schema.UploadSessionSchema: The session with its new offset.
+    """
+    upload_session = await lock_upload_session(db, session_id, current_user)
+    if chunk_lease_held(upload_session):
+        raise HTTPException(
+            status_code=409, detail="Another chunk is being written to this upload session")
+    if offset != upload_session.offset:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Expected offset {upload_session.offset}",
+        )
+
+    lease = models.generate_uuid()
+    try:
+        upload_session.lease = lease
+        upload_session.updated_at = datetime.utcnow()
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    # Don't hold a pooled connection while the chunk is received; the lease is refreshed
+    # with a short transaction of its own
+    await db.close()
+
+    try:
+        new_offset = await storage.append_stream_to_file(
+            leased_stream(db, session_id, lease, request.stream()),
+            storage.session_part_path(session_id),
+            offset,
+            upload_session.size - offset,
+        )
+    except Exception:
+        # The offset stays where it was, so the chunk can be sent again
+        try:
+            await update_chunk_lease(db, session_id, lease, end=True)
+        except SQLAlchemyError:
+            await db.rollback()
+        raise
+
+    try:
+        ended = await update_chunk_lease(db, session_id, lease, end=True, offset=new_offset)
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    if not ended:
+        raise HTTPException(
+            status_code=409, detail="The upload session was taken over by another request")
+
+    upload_session.lease = None
+    upload_session.offset = new_offset
+    return upload_session
+
+
+@router.post("/upload-sessions/{session_id}/finalize", response_model=schema.UploadModelSchema)
+async def finalize_upload_session(
+    session_id: str,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Completes an upload session and turns it into an upload.
+
+    The assembled file is checked for the ZIP signature, the space reserved when the session
+    was created is charged, and the file is moved into the blob store atomically. The session
+    row stays locked until then, so a second finalize or an abort of the same session is
+    refused with 409.
+
+    Args:
+        session_id (str): The ID of the upload session.
+        current_user (models.User): The current user making the request.
+        db (AsyncSession): The database session.
+
+    Raises:
+        HTTPException: If the session does not exist, or 409 if it is incomplete or in use by another request.
+        HTTPException: If the file is not a ZIP archive.
+        HTTPException: If there is a database error.
+
+    Returns:
+        dict: The details of the uploaded file.
+    """
+    upload_session = await lock_upload_session(db, session_id, current_user)
+    if upload_session.offset != upload_session.size:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload incomplete: {upload_session.offset} of {upload_session.size} bytes received",
+        )
+
+    part_location = storage.session_part_path(upload_session.id)
+
+    if await run_in_threadpool(storage.read_signature, part_location) != storage.ZIP_SIGNATURE:
+        raise HTTPException(
+            status_code=400, detail="File must be a ZIP archive")
+
+    digest = await run_in_threadpool(storage.hash_file, part_location)
+
+    # Read before the transaction, which expires the user's attributes if it is rolled back
+    email = current_user.email
+    created = False
+    try:
+        blob_location, created = await storage.add_blob_reference(db, digest, upload_session.size)
+        # Store the content before the row referencing it is committed; this consumes the part file
+        await run_in_threadpool(storage.place_blob, part_location, digest, created)
+
+        new_file = models.Upload(
+            name=upload_session.name,
+            path=blob_location,
+            type=upload_session.type,
+            created_at=datetime.utcnow(),
+            size=upload_session.size,
+            owner_id=current_user.email,
+            blob_digest=digest,
+        )
+
+        await charge_space(db, current_user.email, upload_session.size, upload_session.size)
+        await record_usage(db, current_user.email, new_file.created_at.date(), upload_session.size, 1)
+        db.add(new_file)
+        await db.delete(upload_session)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await run_in_threadpool(storage.unplace_blob, digest, created)
+        await db.rollback()
+        if not await run_in_threadpool(part_location.exists):
+            # The assembled file went to the blob store, so the session can't be finalized again
+            await discard_upload_session(db, session_id, email)
+        if isinstance(e, SQLAlchemyError):
+            raise HTTPException(status_code=500, detail=str(e))
+        raise
+
+    await invalidate_user(current_user.email)
+
+    return new_file
+
+
+async def discard_upload_session(db: AsyncSession, session_id: str, email: str):
+    """
+    Deletes an upload session and gives back its reserved space, in a transaction of its own.
+
+    Errors are swallowed: this runs while another error is being handled.
+    """
+    try:
+        result = await db.execute(
+            delete(models.UploadSession)
+            .where(models.UploadSession.id == session_id)
+            .returning(models.UploadSession.size)
+        )
+        size = result.scalar_one_or_none()
+        if size is not None:
+            await release_space(db, email, size)
+        await db.commit()
+    except SQLAlchemyError:
+        await db.rollback()
+
+
+@router.delete("/upload-sessions/{session_id}")
+async def abort_upload_session(
+    session_id: str,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Cancels an upload session and discards the data received so far.
+
+    Raises:
+        HTTPException: If the session does not exist or does not belong to the current user,
+            or 409 if another request is using it.
+    """
+    upload_session = await lock_upload_session(db, session_id, current_user)
+    if chunk_lease_held(upload_session):
+        raise HTTPException(
+            status_code=409, detail="Another chunk is being written to this upload session")
+
+    try:
+        await db.delete(upload_session)
+        await release_space(db, current_user.email, upload_session.size)
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+    await run_in_threadpool(storage.discard_file, storage.session_part_path(session_id))
+
     return status.HTTP_204_NO_CONTENT
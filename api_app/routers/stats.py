@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Depends
+from api_app.archives import zip_index_cache
+from api_app.database import get_pool_status
+from api_app.Oauth2 import get_auth_cache_stats, require_internal_token
+from api_app.mailer import mailer
+
+
+router = APIRouter(
+    prefix="/stats",
+    tags={"Stats": "live statistics about the api internals"},
+    dependencies=[Depends(require_internal_token)],
+)
+
+
+@router.get("/pool")
+async def pool_stats():
+    """
+    Returns live statistics for the database connection pool.
+
+    Returns:
+    - The pool size, the number of checked out and idle connections, the current overflow,
+      and the number of checkouts, timeouts and checkout wait times since the worker started
+    """
+    return get_pool_status()
+
+
+@router.get("/auth-cache")
+async def auth_cache_stats():
+    """
+    Returns the size, hit and miss counts of the token and user caches used for authentication.
+    """
+    return get_auth_cache_stats()
+
+
+@router.get("/zip-index-cache")
+async def zip_index_cache_stats():
+    """
+    Returns the size, hit and miss counts of the cache of parsed ZIP central directories.
+    """
+    return zip_index_cache.stats()
+
+
+@router.get("/mail")
+async def mail_stats():
+    """
+    Returns the number of queued emails and the sent, failed, dropped and retried counts
+    of the mailer, along with the number of SMTP connections it has opened.
+    """
+    return mailer.stats()
@@ -1,21 +1,29 @@
 import datetime
-from sqlalchemy import extract, func
 from api_app.config import settings
 from .. import models, Oauth2, schema
-from ..models import get_db
+from ..models import get_async_db
 from ..config import settings
-from sqlalchemy.orm import Session
-from fastapi import Response, status
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Request, Response, status
 from fastapi import (
     Depends,
     APIRouter,
 )
-import httpx
 from fastapi.responses import JSONResponse, RedirectResponse
 from fastapi.exceptions import HTTPException
 from datetime import datetime, timedelta
-from sqlalchemy import func, cast, Date
 from datetime import date
+from typing import Optional
+from fastapi import Query
+from ..usage import (
+    GRANULARITIES,
+    monthly_usage_statement,
+    usage_statement,
+    yearly_usage_statement,
+)
+from ..versions import get_version, not_modified, user_etag
 
 router = APIRouter(
     prefix="/user",
@@ -29,21 +37,33 @@ REDIRECT_URI = settings.REDIRECT_URI
 TOKEN_URL = settings.TOKEN_URL
 USER_INFO_URL = settings.USER_INFO_URL
 
+DEMO_EMAIL = "demouser@email.com"
+DEMO_SUB = "10660460994372209672$"
+
 
 # Function to get the monthly usage
-def get_monthly_usage(db: Session, email: str):
-    one_month_ago = datetime.utcnow() - timedelta(days=30)
-    total_size = (
-        db.query(func.sum(models.Upload.size))
-        .filter(
-            models.Upload.owner_id == email, models.Upload.created_at >= one_month_ago
+async def get_monthly_usage(db: AsyncSession, email: str):
+    total_size = await db.scalar(monthly_usage_statement(email))
+    return total_size or 0
+
+
+def user_history_statement(email: str, day: date):
+    # Compare created_at against a range rather than casting it so the index can be used
+    start_of_day = datetime.combine(day, datetime.min.time())
+    return (
+        select(models.History)
+        .where(models.History.user_email == email)
+        .where(
+            models.History.created_at >= start_of_day,
+            models.History.created_at < start_of_day + timedelta(days=1),
         )
-        .scalar()
     )
-    return total_size or 0
 
 
 async def get_current_user(request: str):
+    # httpx is only needed to log in with Google, so it is imported on the first login
+    import httpx
+
     try:
         # Extracting the authorization code from the request's query parameters
         authorization_code = request
@@ -87,7 +107,7 @@ async def get_current_user(request: str):
 @router.post("/login/google")
 async def login_callback(
     request: schema.GoogleLoginRequest,  # Use the Pydantic model here
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Handles the callback from Google OAuth2 login, and creates or retrieves the user's account in the database.
@@ -105,11 +125,10 @@ async def login_callback(
     # Here you can handle user login, such as creating a session or JWT
     current_user = await get_current_user(request.code)
     if current_user.get("sub"):
-        user = (
-            db.query(models.User)
-            .filter(models.User.sub == current_user.get("sub"))
-            .first()
+        result = await db.execute(
+            select(models.User).where(models.User.sub == current_user.get("sub"))
         )
+        user = result.scalars().first()
         if not user:
             new_user = models.User(
                 email=current_user.get("email"),
@@ -118,7 +137,7 @@ async def login_callback(
                 picture=current_user.get("picture"),
             )
             db.add(new_user)
-            db.commit()
+            await db.commit()
             user = new_user  # Update the user variable to reference the new user
 
         access_token, refresh_token = Oauth2.create_access_token(
@@ -173,7 +192,7 @@ async def refresh_token(refresh_token: schema.RefreshTokenSchema):
 @router.get("/get-yearly-usage")
 async def get_yearly_usage(
     current_user: models.User = Depends(Oauth2.get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Retrieves the total size of uploaded files for each month of the current year, for the authenticated user.
@@ -188,19 +207,8 @@ async def get_yearly_usage(
     Raises:
     - None
     """
-    yearly_usage = (
-        db.query(
-            extract("month", models.Upload.created_at).label("month"),
-            func.sum(models.Upload.size).label("total_size"),
-        )
-        .filter(
-            models.Upload.owner_id == current_user.email,
-            extract("year", models.Upload.created_at)
-            == func.extract("year", func.current_date()),
-        )
-        .group_by(extract("month", models.Upload.created_at))
-        .all()
-    )
+    result = await db.execute(yearly_usage_statement(current_user.email))
+    yearly_usage = result.all()
 
     months = [str(record.month) for record in yearly_usage]
     usages = [record.total_size for record in yearly_usage]
@@ -208,15 +216,67 @@ async def get_yearly_usage(
     return {"month": months, "usage": usages}
 
 
+@router.get("/usage")
+async def get_usage(
+    granularity: str = Query("day"),
+    start: Optional[date] = Query(None),
+    end: Optional[date] = Query(None),
+    current_user: models.User = Depends(Oauth2.get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Retrieves the total size and number of uploads of the authenticated user per day, week or month.
+
+    Parameters:
+    - granularity: the size of the buckets, one of `day`, `week` or `month`
+    - start: the first day of the range, defaults to one year before `end`
+    - end: the last day of the range, defaults to today
+    - current_user: the authenticated user, obtained from the access token
+    - db: the database session dependency
+
+    Returns:
+    - A dictionary containing the granularity and the buckets that have uploads, each with its start date, total size (in bytes) and number of uploads
+
+    Raises:
+    - HTTP 400 Bad Request if the granularity is unknown or `start` is after `end`
+    """
+    if granularity not in GRANULARITIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"granularity must be one of {', '.join(GRANULARITIES)}",
+        )
+
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=365)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+    result = await db.execute(
+        usage_statement(current_user.email, granularity, start, end)
+    )
+
+    return {
+        "granularity": granularity,
+        "buckets": [
+            {"start": record.start, "size": record.size, "uploads": record.uploads}
+            for record in result.all()
+        ],
+    }
+
+
 @router.get("/info", response_model=schema.UserBase)
 async def get_user_information(
+    request: Request,
+    response: Response,
     current_user: models.User = Depends(Oauth2.get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Retrieves the user information for the authenticated user.
 
     Parameters:
+    - request: the incoming HTTP request, whose If-None-Match header is checked against the ETag
+    - response: the outgoing HTTP response, carrying the ETag derived from the user's version
     - current_user: the authenticated user, obtained from the access token
     - db: the database session dependency
 
@@ -226,12 +286,17 @@ async def get_user_information(
     Raises:
     - None
     """
-    user_info = (
-        db.query(models.User).filter(
-            models.User.email == current_user.email).first()
-    )
+    version = await get_version(db, current_user.email)
+    unchanged = not_modified(request, response, user_etag(current_user.email, version, "info"))
+    if unchanged:
+        return unchanged
 
-    return user_info
+    # The dependency has already loaded the user in this session, possibly from a cached
+    # row; reload it if it predates the latest change
+    if current_user.version != version:
+        await db.refresh(current_user)
+        await Oauth2.invalidate_user(current_user.email)
+    return current_user
 
 
 @router.get("/google_redirect")
@@ -248,7 +313,7 @@ async def login():
 async def demo_account_login(
     response: Response,
     request: schema.DemoAccount,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Logs in a user with a demo account, or returns an error if the account does not exist.
@@ -264,27 +329,27 @@ async def demo_account_login(
     Raises:
     - HTTP 403 Forbidden if the demo account credentials are invalid
     """
-    user = (
-        db.query(models.User)
-        .filter(models.User.sub == request.password, models.User.email == request.email)
-        .first()
+    result = await db.execute(
+        select(models.User).where(
+            models.User.sub == request.password, models.User.email == request.email
+        )
     )
+    user = result.scalars().first()
 
-    if user is None:
-        demo_user = models.User(
-            email="demouser@email.com",
-            sub="10660460994372209672$",
+    # The demo account is created the first time someone logs in with its credentials
+    if user is None and (request.email, request.password) == (DEMO_EMAIL, DEMO_SUB):
+        user = models.User(
+            email=DEMO_EMAIL,
+            sub=DEMO_SUB,
             picture="https://images.unsplash.com/photo-1510915228340-29c85a43dcfe?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxzZWFyY2h8MjB8fHByb2dyYW1tZXIlMjB3b3JraW5nfGVufDB8fDB8fHww&auto=format&fit=crop&w=500&q=60",
             name="Demo User",
         )
-        db.add(demo_user)
-        db.commit()
-
-    user = (
-        db.query(models.User)
-        .filter(models.User.sub == request.password, models.User.email == request.email)
-        .first()
-    )
+        db.add(user)
+        try:
+            await db.commit()
+        except IntegrityError:
+            # Created by a concurrent login in the meantime
+            await db.rollback()
 
     if user is None:
         response.status_code = status.HTTP_403_FORBIDDEN
@@ -302,13 +367,17 @@ async def demo_account_login(
 
 @router.get("/history", response_model=list[schema.HistorySchema])
 async def user_history(
+    request: Request,
+    response: Response,
     current_user: models.User = Depends(Oauth2.get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Retrieves the history of shared uploads for the authenticated user, for the current day.
 
     Parameters:
+    - request: the incoming HTTP request, whose If-None-Match header is checked against the ETag
+    - response: the outgoing HTTP response, carrying the ETag derived from the user's version and the day
     - current_user: the authenticated user, obtained from the access token
     - db: the database session dependency
 
@@ -321,12 +390,15 @@ async def user_history(
     # Calculate the current date
     today = date.today()
 
+    # The day is part of the tag, since the history starts over every day
+    version = await get_version(db, current_user.email)
+    etag = user_etag(current_user.email, version, "history", today.isoformat())
+    unchanged = not_modified(request, response, etag)
+    if unchanged:
+        return unchanged
+
     # Query for history entries for the current day
-    user_history = (
-        db.query(models.History)
-        .filter(models.History.user_email == current_user.email)
-        .filter(cast(models.History.created_at, Date) == today)
-        .all()
-    )
+    result = await db.execute(user_history_statement(current_user.email, today))
+    user_history = result.scalars().all()
 
     return user_history
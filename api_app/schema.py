@@ -1,5 +1,5 @@
 from fastapi import File, UploadFile
-from pydantic import BaseModel, ConfigDict, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
 from typing import List, Optional
 from datetime import datetime
 
@@ -55,6 +55,24 @@ class ShareUploadSchema(BaseModel):
     description: str = None
 
 
+class BulkShareUploadSchema(BaseModel):
+    upload_ids: List[str] = Field(min_length=1, max_length=100)
+    recipient_emails: List[EmailStr] = Field(min_length=1, max_length=500)
+    permission: str = "read"
+    description: str = None
+
+
+class BulkShareResultSchema(BaseModel):
+    uploads: int
+    recipients: int
+    shares: int
+    emails_queued: int
+
+
+class BundleRequestSchema(BaseModel):
+    upload_ids: List[str] = Field(min_length=1, max_length=100)
+
+
 class DemoAccount(BaseModel):
     email: EmailStr
     password: str
@@ -71,3 +89,21 @@ class HistorySchema(BaseModel):
 
 class RefreshTokenSchema(BaseModel):
     refresh_token: str
+
+
+class UploadSessionCreate(BaseModel):
+    name: str
+    file_type: str
+    size: int
+
+
+class UploadSessionSchema(BaseModel):
+    id: str
+    name: str
+    type: str
+    size: int
+    offset: int
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
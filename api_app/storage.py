@@ -0,0 +1,420 @@
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from typing import Tuple
+import multipart
+from fastapi import Request
+from fastapi.exceptions import HTTPException
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+from sqlalchemy import any_, delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from api_app import models
+from api_app.backends import LocalBackend, create_backend
+from api_app.config import settings
+from api_app.quota import free_space
+from api_app.usage import record_usage
+from api_app.versions import bump_versions
+
+
+ZIP_SIGNATURE = b"PK\x03\x04"
+
+# Bytes a multipart body may add to the file it carries (boundaries, part headers and
+# small fields); the rest of `Content-Length` is reserved before the body is read
+MULTIPART_OVERHEAD = 16 * 1024
+
+STAGING_FOLDER = Path("Uploads/.staging")
+SESSION_FOLDER = Path("Uploads/.sessions")
+
+
+def discard_file(path: Path):
+    """
+    Removes a file if it exists, e.g. a staged upload that was refused.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Blobs are kept in the configured backend under their SHA-256 digest
+blob_backend = create_backend()
+
+# Uploads stored before deduplication live in Uploads/<email>/, under the path in their row
+legacy_files = LocalBackend(".", shard_depth=0)
+
+
+def upload_location(upload: models.Upload):
+    """
+    Returns the backend holding the content of an upload and its key there.
+    """
+    if upload.blob_digest:
+        return blob_backend, upload.blob_digest
+    return legacy_files, upload.path
+
+
+def session_part_path(session_id: str) -> Path:
+    """
+    Returns the path of the partial file backing an upload session.
+    """
+    return SESSION_FOLDER / f"{session_id}.part"
+
+
+def create_session_part(session_id: str):
+    """
+    Creates the empty partial file of a new upload session.
+    """
+    SESSION_FOLDER.mkdir(parents=True, exist_ok=True)
+    session_part_path(session_id).touch()
+
+
+def read_signature(path: Path) -> bytes:
+    with path.open("rb") as part:
+        return part.read(len(ZIP_SIGNATURE))
+
+
+def hash_file(path: Path) -> str:
+    """
+    Returns the SHA-256 hex digest of a file, reading it in chunks.
+    """
+    hasher = hashlib.sha256()
+    with path.open("rb") as source:
+        while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _write_and_hash(buffer, hasher, chunk: bytes):
+    hasher.update(chunk)
+    buffer.write(chunk)
+
+
+class MultipartFile:
+    """
+    The file field of a `multipart/form-data` request body, read as the body arrives.
+
+    Starlette's form parsing spools the whole body to a temporary file before the
+    endpoint runs. This feeds the body to python-multipart one network chunk at a time
+    instead and hands out the file's bytes as soon as they are parsed, so they can be
+    checked, counted against the quota and written once. Other fields are skipped.
+    """
+
+    def __init__(self, request: Request, field_name: str = "file"):
+        self.request = request
+        self.field_name = field_name
+        self.filename = None
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = None
+        self._reading = False
+        self._found = False
+        self._complete = False
+        self._data = []
+
+    def _on_part_begin(self):
+        self._disposition = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._disposition or b"")
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if not self._found and name == self.field_name and b"filename" in options:
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self._found = self._reading = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._reading:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._reading:
+            self._complete = True
+        self._reading = False
+
+    async def chunks(self):
+        """
+        Yields the content of the file field as it is received.
+
+        Raises:
+            HTTPException: If the body is not multipart, is malformed, has no such file field
+                or ends before the file field does.
+        """
+        _, params = parse_options_header(self.request.headers.get("content-type", ""))
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise HTTPException(
+                status_code=400, detail="Request must be multipart/form-data")
+
+        parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+        try:
+            async for body in self.request.stream():
+                parser.write(body)
+                data, self._data = self._data, []
+                for chunk in data:
+                    if chunk:
+                        yield chunk
+            parser.finalize()
+        except MultipartParseError:
+            raise HTTPException(status_code=400, detail="Malformed multipart body")
+
+        if not self._found:
+            raise HTTPException(
+                status_code=400, detail=f"Missing file field '{self.field_name}'")
+        # The parser holds back the bytes that could start a boundary, so a body cut
+        # short inside the file looks like a shorter file unless its end was seen
+        if not self._complete:
+            raise HTTPException(status_code=400, detail="Incomplete multipart body")
+
+
+async def stream_upload_to_staging(chunks, reserve):
+    """
+    Writes an upload to a staging file as its chunks arrive, hashing it on the way.
+
+    The ZIP signature is checked as soon as the first bytes arrive and quota is reserved
+    as bytes arrive, so an oversized or invalid upload is rejected without reading the
+    rest of it. Chunks are gathered up to `UPLOAD_CHUNK_SIZE` bytes before each write, and
+    hashing and disk writes run in the threadpool to keep the event loop free. The
+    staged file is removed if anything goes wrong.
+
+    Args:
+        chunks: The async iterator yielding the content (e.g. `MultipartFile.chunks()`).
+        reserve: An async callable given the number of bytes received so far, which
+            raises if they do not fit in the user's quota (e.g. `UploadReservation.ensure`).
+
+    Raises:
+        HTTPException: If the file is not a ZIP archive or does not fit in the user's quota.
+
+    Returns:
+        tuple: The staged file path, its size in bytes and its SHA-256 hex digest.
+    """
+    STAGING_FOLDER.mkdir(parents=True, exist_ok=True)
+    staged_location = STAGING_FOLDER / f"{uuid.uuid4()}.part"
+    buffer = await run_in_threadpool(staged_location.open, "wb")
+    hasher = hashlib.sha256()
+    pending = bytearray()
+    received = 0
+
+    async def flush():
+        if pending:
+            await run_in_threadpool(_write_and_hash, buffer, hasher, bytes(pending))
+            pending.clear()
+
+    try:
+        async for chunk in chunks:
+            # Check if the file is a ZIP by reading its signature
+            if received < len(ZIP_SIGNATURE):
+                head = bytes(pending[:len(ZIP_SIGNATURE)]) + chunk[:len(ZIP_SIGNATURE)]
+                if not ZIP_SIGNATURE.startswith(head[:len(ZIP_SIGNATURE)]):
+                    raise HTTPException(
+                        status_code=400, detail="File must be a ZIP archive")
+
+            received += len(chunk)
+            await reserve(received)
+
+            pending.extend(chunk)
+            if len(pending) >= settings.UPLOAD_CHUNK_SIZE:
+                await flush()
+
+        if received < len(ZIP_SIGNATURE):
+            raise HTTPException(
+                status_code=400, detail="File must be a ZIP archive")
+        await flush()
+    except BaseException:
+        await run_in_threadpool(buffer.close)
+        await run_in_threadpool(discard_file, staged_location)
+        raise
+
+    await run_in_threadpool(buffer.close)
+    return staged_location, received, hasher.hexdigest()
+
+
+def _write_at(path: Path, offset: int, chunk: bytes):
+    with path.open("r+b") as part:
+        part.seek(offset)
+        part.write(chunk)
+        part.truncate()
+
+
+async def append_stream_to_file(stream, path: Path, offset: int, max_bytes: int):
+    """
+    Writes a request body stream into a partial upload file starting at `offset`.
+
+    Incoming data is buffered up to `UPLOAD_CHUNK_SIZE` bytes before each write so
+    memory stays bounded. Anything past `offset` left over from an interrupted
+    request is overwritten. If the client disconnects half way, the bytes that
+    have already been received are kept so the upload can be resumed from there.
+
+    Args:
+        stream: The async iterator yielding the request body (e.g. `request.stream()`).
+        path (Path): The partial file of the upload session.
+        offset (int): The position at which the data starts.
+        max_bytes (int): The maximum number of bytes this request may add.
+
+    Raises:
+        HTTPException: If the body is larger than `max_bytes`.
+
+    Returns:
+        int: The new offset, i.e. `offset` plus the number of bytes written.
+    """
+    pending = bytearray()
+    written = 0
+
+    async def flush():
+        nonlocal written
+        if pending:
+            await run_in_threadpool(_write_at, path, offset + written, bytes(pending))
+            written += len(pending)
+            pending.clear()
+
+    try:
+        async for chunk in stream:
+            if written + len(pending) + len(chunk) > max_bytes:
+                raise HTTPException(
+                    status_code=400, detail="Chunk exceeds the announced upload size")
+            pending.extend(chunk)
+            if len(pending) >= settings.UPLOAD_CHUNK_SIZE:
+                await flush()
+    except ClientDisconnect:
+        pass
+
+    await flush()
+    return offset + written
+
+
+async def add_blob_reference(db: AsyncSession, digest: str, size: int) -> Tuple[str, bool]:
+    """
+    Records one more reference to a blob, creating its row if it is new.
+
+    The upsert is atomic so concurrent uploads of the same content share a single row,
+    and it keeps the row locked until the caller's transaction ends. It only touches the
+    session; the caller then stores the content with `place_blob` before committing.
+
+    Returns:
+        tuple: The location of the blob, and whether its row was created.
+    """
+    location = blob_backend.location(digest)
+    result = await db.execute(
+        insert(models.Blob)
+        .values(digest=digest, path=location, size=size, ref_count=1)
+        .on_conflict_do_update(
+            index_elements=[models.Blob.digest],
+            set_={"ref_count": models.Blob.ref_count + 1},
+        )
+        .returning(models.Blob.ref_count)
+    )
+    return location, result.scalar_one() == 1
+
+
+def place_blob(staged_location: Path, digest: str, created: bool):
+    """
+    Moves a staged file into the blob backend, before the reference to it is committed.
+
+    The blob row is locked by `add_blob_reference` at that point, so the last reference
+    cannot be dropped concurrently. An existing blob is left as it is and the staged file
+    removed, unless its object has gone missing.
+    """
+    if created or not blob_backend.exists(digest):
+        blob_backend.put_file(staged_location, digest)
+    else:
+        discard_file(staged_location)
+
+
+def unplace_blob(digest: str, created: bool):
+    """
+    Undoes `place_blob` when the transaction adding the reference is not committed.
+
+    Removes the blob if its row was created by that transaction. Call it before rolling
+    back, while the blob row is still locked.
+    """
+    if created:
+        blob_backend.delete(digest)
+
+
+async def release_blob_reference(db: AsyncSession, digest: str):
+    """
+    Drops one reference to a blob, deleting the row and the file with the last one.
+
+    The file is unlinked while the row deletion is still uncommitted so that an upload
+    of the same content waits on the row lock and places its own copy afterwards.
+    """
+    await db.execute(
+        update(models.Blob)
+        .where(models.Blob.digest == digest)
+        .values(ref_count=models.Blob.ref_count - 1)
+    )
+    result = await db.execute(
+        delete(models.Blob)
+        .where(models.Blob.digest == digest, models.Blob.ref_count <= 0)
+        .returning(models.Blob.digest)
+    )
+    unreferenced = result.first()
+
+    if unreferenced:
+        await run_in_threadpool(blob_backend.delete, unreferenced.digest)
+
+
+def delete_recipients_statement(upload_id: str):
+    """
+    Returns the statement deleting the recipients of every share of an upload.
+    """
+    shares = select(models.SharedUpload.id).where(models.SharedUpload.upload_id == upload_id)
+    # `= ANY(ARRAY(...))` rather than `IN (...)`, so both sides of the OR can use their index
+    return delete(models.SharedRecipient).where(or_(
+        models.SharedRecipient.upload_id == upload_id,
+        models.SharedRecipient.shared_upload_id == any_(func.array(shares.scalar_subquery())),
+    ))
+
+
+async def remove_upload(db: AsyncSession, upload: models.Upload):
+    """
+    Deletes an upload along with the shares of it, in the caller's transaction.
+
+    The owner's space and usage are given back, the versions of the owner and the
+    recipients are bumped, and the blob reference is dropped, removing the blob with
+    the last one. Files of uploads stored before deduplication are left for the
+    caller to remove from `legacy_files` once the transaction commits.
+    """
+    recipients = await db.execute(
+        delete_recipients_statement(upload.id)
+        .returning(models.SharedRecipient.recipient_email)
+        .execution_options(synchronize_session=False)
+    )
+    # The upload disappears from the listings of the users it was shared with
+    await bump_versions(db, recipients.scalars().all())
+    await db.execute(
+        delete(models.SharedUpload)
+        .where(models.SharedUpload.upload_id == upload.id)
+        .execution_options(synchronize_session=False)
+    )
+    await db.delete(upload)
+
+    await free_space(db, upload.owner_id, upload.size)
+    await record_usage(db, upload.owner_id, upload.created_at.date(), -upload.size, -1)
+
+    if upload.blob_digest:
+        # Drop the reference, removing the blob with the last one
+        await db.flush()
+        await release_blob_reference(db, upload.blob_digest)
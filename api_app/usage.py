@@ -0,0 +1,82 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import Date, cast, extract, func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from api_app import models
+
+
+GRANULARITIES = ("day", "week", "month")
+
+
+async def record_usage(db: AsyncSession, email: str, day: date, size: int, uploads: int):
+    """
+    Adds `size` bytes and `uploads` uploads to a user's usage for `day`.
+
+    Pass negative values when an upload is deleted. The upsert runs in the caller's
+    transaction, so the rollup changes together with the upload rows.
+    """
+    statement = insert(models.DailyUsage).values(
+        user_email=email, day=day, size=size, uploads=uploads
+    )
+    await db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[models.DailyUsage.user_email, models.DailyUsage.day],
+            set_={
+                "size": models.DailyUsage.size + statement.excluded.size,
+                "uploads": models.DailyUsage.uploads + statement.excluded.uploads,
+            },
+        )
+    )
+
+
+def yearly_usage_statement(email: str):
+    start_of_year = date(datetime.utcnow().year, 1, 1)
+    return (
+        select(
+            extract("month", models.DailyUsage.day).label("month"),
+            func.sum(models.DailyUsage.size).label("total_size"),
+        )
+        .where(
+            models.DailyUsage.user_email == email,
+            models.DailyUsage.day >= start_of_year,
+        )
+        .group_by(extract("month", models.DailyUsage.day))
+        .having(func.sum(models.DailyUsage.uploads) > 0)
+        .order_by(extract("month", models.DailyUsage.day))
+    )
+
+
+def monthly_usage_statement(email: str):
+    one_month_ago = (datetime.utcnow() - timedelta(days=30)).date()
+    return select(func.sum(models.DailyUsage.size)).where(
+        models.DailyUsage.user_email == email,
+        models.DailyUsage.day >= one_month_ago,
+    )
+
+
+def usage_statement(email: str, granularity: str, start: date, end: date):
+    """
+    Builds the query for a user's usage between `start` and `end` (inclusive),
+    summed per day, week or month. Only buckets with uploads are returned.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity!r}")
+    # Inline the granularity so the SELECT and GROUP BY expressions are identical
+    bucket = cast(
+        func.date_trunc(literal_column(f"'{granularity}'"), models.DailyUsage.day), Date
+    ).label("start")
+    return (
+        select(
+            bucket,
+            func.sum(models.DailyUsage.size).label("size"),
+            func.sum(models.DailyUsage.uploads).label("uploads"),
+        )
+        .where(
+            models.DailyUsage.user_email == email,
+            models.DailyUsage.day >= start,
+            models.DailyUsage.day <= end,
+        )
+        .group_by(bucket)
+        .having(func.sum(models.DailyUsage.uploads) > 0)
+        .order_by(bucket)
+    )
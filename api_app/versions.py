@@ -0,0 +1,63 @@
+import hashlib
+from fastapi import Request, Response
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from api_app import models
+from api_app.downloads import etag_matches
+
+
+# `users.version` is bumped in the same transaction as every change to what a user
+# sees through /file/user_items, /user/info or /user/history: uploads and deletes
+# (with the space they charge or free), shares (for the owner and the recipients) and
+# quota changes. The polled endpoints derive their ETag from it, so an unchanged poll
+# costs one primary key lookup instead of the full queries.
+
+
+async def bump_versions(db: AsyncSession, emails):
+    """
+    Bumps the version of several users, in the caller's transaction.
+
+    Emails without an account, such as recipients who haven't signed up, are ignored.
+    """
+    emails = sorted(set(emails))
+    if emails:
+        await db.execute(
+            update(models.User)
+            .where(models.User.email.in_(emails))
+            .values(version=models.User.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def get_version(db: AsyncSession, email: str) -> int:
+    """
+    Reads a user's version from the database, bypassing the cached user rows.
+    """
+    result = await db.execute(select(models.User.version).where(models.User.email == email))
+    return result.scalar_one_or_none() or 0
+
+
+def user_etag(email: str, version: int, *parts) -> str:
+    """
+    Builds a weak entity tag from a user's version and whatever else shapes the response,
+    e.g. the endpoint and its query parameters.
+
+    The email is hashed into the tag, so a browser switching accounts never gets a 304
+    for the previous user's cached response.
+    """
+    digest = hashlib.sha256(repr((email, *parts)).encode()).hexdigest()[:16]
+    return f'W/"{version}-{digest}"'
+
+
+def not_modified(request: Request, response: Response, etag: str):
+    """
+    Returns a 304 response if the client already has the representation tagged `etag`.
+
+    Otherwise the tag is set on `response`, the response FastAPI sends the endpoint's
+    return value with, and None is returned.
+    """
+    headers = {"etag": etag, "cache-control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -0,0 +1,71 @@
+"""
+Measures how many share emails per second can be built, before and after caching templates.
+
+"before" repeats what every share used to do: build a Jinja2 environment, parse
+``sharetemplate.html``, render it and run Premailer over the result. "after"
+is ``build_share_email``, which renders the precompiled, pre-inlined template.
+Both build the complete MIME message, and no email is sent.
+
+Usage::
+
+    python -m benchmarks.email_render [--seconds 3]
+"""
+import argparse
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from jinja2 import Environment, FileSystemLoader
+from premailer import Premailer
+
+from api_app.extras import TEMPLATE_FOLDER, build_share_email, load_email_templates
+
+TEMPLATE_DATA = {
+    "reciepient_email": "recipient@example.com",
+    "user_email": "owner@example.com",
+    "description": "Quarterly reports",
+    "file_path": "https://xendpal.vercel.app",
+    "file_names": ["reports.zip"],
+    "current_year": 2024,
+    "frontend_url": "https://xendpal.com",
+    "subject": "Xendpal File Share",
+}
+
+
+def build_share_email_uncached(email, subject, template_data, template_name="sharetemplate.html"):
+    env = Environment(loader=FileSystemLoader(str(TEMPLATE_FOLDER)))
+    message = env.get_template(template_name).render(**template_data)
+    msg = MIMEMultipart("alternative")
+    msg.attach(MIMEText(Premailer(message).transform(), "html"))
+    msg["Subject"] = subject
+    msg["To"] = email
+    return msg
+
+
+def messages_per_second(build, seconds: float) -> float:
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        build("recipient@example.com", "Xendpal File Share", TEMPLATE_DATA).as_bytes()
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--seconds", type=float, default=3.0, help="duration of each run")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    load_email_templates()
+    print(f"templates compiled in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    before = messages_per_second(build_share_email_uncached, args.seconds)
+    after = messages_per_second(build_share_email, args.seconds)
+    print(f"before: {before:10.1f} messages/s")
+    print(f"after:  {after:10.1f} messages/s  ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
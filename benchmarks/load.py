@@ -0,0 +1,491 @@
+"""
+Load tests the API over HTTP and compares the results with a stored baseline.
+
+The script creates a throwaway database next to the configured one, seeds it with
+users, uploads and history, and boots ``api_app.main:app`` under uvicorn in a
+temporary directory, so uploads land in a scratch ``Uploads`` folder and the real
+data is never touched. Share emails go to a local SMTP sink that discards them.
+
+Requests are signed with tokens from ``Oauth2.create_access_token``. Each endpoint
+is first driven on its own, then all of them together in a mixed workload. For every
+phase and endpoint the script reports throughput, p50/p95/p99 latency and the peak
+RSS of the server process. With ``--save-baseline`` the results are stored; otherwise
+they are compared with the stored baseline and the script exits with a non-zero
+status if throughput, p95 latency or peak RSS regressed beyond ``--tolerance``.
+
+The configured database user needs the CREATEDB privilege. A disposable server
+works well, e.g. ``docker run -p 5432:5432 -e POSTGRES_PASSWORD=... postgres:16``.
+
+Usage::
+
+    python -m benchmarks.load [--duration 10] [--concurrency 16] [--users 50]
+                              [--baseline benchmarks/load_baseline.json] [--save-baseline]
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+from api_app import Oauth2, models
+from api_app.config import settings
+from api_app.database import SQLALCHEMY_DATABASE_URL
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "load_baseline.json"
+
+# Share of requests each endpoint gets in the mixed phase
+MIXED_WEIGHTS = {
+    "upload": 10,
+    "user_items": 35,
+    "share_upload": 10,
+    "user_info": 25,
+    "user_history": 20,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def create_database(name: str):
+    """
+    Creates an empty database `name` with the application's tables, and returns its URL.
+    """
+    url = make_url(SQLALCHEMY_DATABASE_URL)
+    admin = create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    with admin.connect() as connection:
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+        connection.execute(text(f'CREATE DATABASE "{name}"'))
+    admin.dispose()
+
+    url = url.set(database=name)
+    engine = create_engine(url)
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
+    return url
+
+
+def drop_database(name: str):
+    url = make_url(SQLALCHEMY_DATABASE_URL)
+    admin = create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    with admin.connect() as connection:
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+    admin.dispose()
+
+
+def seed(url, users: int, uploads_per_user: int, history_per_user: int):
+    """
+    Fills the database with users, their uploads and today's history entries.
+
+    Returns:
+        dict: The ids of the uploads of every user, by email.
+    """
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    emails = [f"load{i}@example.com" for i in range(users)]
+    upload_ids = {email: [] for email in emails}
+    rows = {"users": [], "uploads": [], "history": []}
+
+    for email in emails:
+        rows["users"].append({
+            "email": email,
+            "sub": email,
+            "name": email,
+            "picture": "https://example.com/avatar.png",
+            "space": 0,
+            "max_space": 2**40,
+        })
+        for _ in range(uploads_per_user):
+            upload_id = str(uuid.uuid4())
+            upload_ids[email].append(upload_id)
+            rows["uploads"].append({
+                "id": upload_id,
+                "name": "archive.zip",
+                "path": f"Uploads/{email}/archive.zip",
+                "type": rng.choice(["file", "folder"]),
+                "created_at": now - timedelta(minutes=rng.randrange(60 * 24 * 365)),
+                "size": rng.randrange(1, 2**24),
+                "owner_id": email,
+            })
+        for _ in range(history_per_user):
+            rows["history"].append({
+                "id": str(uuid.uuid4()),
+                "created_at": now - timedelta(seconds=rng.randrange(60 * 60)),
+                "message": "Your file share - archive.zip - was successful",
+                "user_email": email,
+            })
+
+    engine = create_engine(url)
+    with engine.begin() as connection:
+        connection.execute(models.User.__table__.insert(), rows["users"])
+        connection.execute(models.Upload.__table__.insert(), rows["uploads"])
+        connection.execute(models.History.__table__.insert(), rows["history"])
+        connection.execute(text("ANALYZE"))
+    engine.dispose()
+    return upload_ids
+
+
+class SmtpSink:
+    """
+    Answers just enough SMTP for the mailer to deliver its messages, and discards them.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.connections = {}
+
+    async def handle(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        writer.write(b"220 load-benchmark ESMTP\r\n")
+        in_data = False
+        try:
+            while line := await reader.readline():
+                if in_data:
+                    if line == b".\r\n":
+                        in_data = False
+                        self.messages += 1
+                        writer.write(b"250 OK\r\n")
+                else:
+                    command = line[:4].upper()
+                    if command == b"DATA":
+                        in_data = True
+                        writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    elif command == b"QUIT":
+                        writer.write(b"221 Bye\r\n")
+                        await writer.drain()
+                        break
+                    else:
+                        writer.write(b"250 OK\r\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def close_connections(self):
+        # Sessions the mailer keeps open would otherwise be cancelled mid-read on exit
+        tasks = list(self.connections)
+        for writer in self.connections.values():
+            writer.transport.abort()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def server_environment(database: str, smtp_port: int, workdir: str):
+    environment = dict(os.environ)
+    for name, value in settings.model_dump().items():
+        if value is not None:
+            environment[name] = str(value)
+    environment.update({
+        "DATABASE_NAME": database,
+        "EMAIL_HOST": "127.0.0.1",
+        "EMAIL_PORT": str(smtp_port),
+        "EMAIL_USE_TLS": "false",
+        "EMAIL_HOST_PASSWORD": "",
+        "STORAGE_BACKEND": "local",
+        "STORAGE_LOCAL_ROOT": os.path.join(workdir, "Uploads", "blobs"),
+        # The workload deliberately exceeds the per-user limits
+        "RATE_LIMIT_UPLOADS_PER_USER": "0",
+        "RATE_LIMIT_UPLOADS_PER_IP": "0",
+        "RATE_LIMIT_SHARES_PER_USER": "0",
+        "RATE_LIMIT_SHARES_PER_IP": "0",
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")])),
+    })
+    return environment
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def wait_for_server(client: httpx.AsyncClient, server: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with status {server.returncode}")
+        try:
+            await client.get("/")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("The server did not start in time")
+
+
+def make_archives(count: int, size: int):
+    archives = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            archive.writestr("data.bin", os.urandom(size))
+        archives.append(buffer.getvalue())
+    return archives
+
+
+class Workload:
+    """
+    Builds the requests of every endpoint for randomly picked users.
+    """
+
+    def __init__(self, upload_ids, archives):
+        self.users = []
+        for email, ids in upload_ids.items():
+            access_token, _ = Oauth2.create_access_token({"user_email": email})
+            self.users.append(({"Authorization": f"Bearer {access_token}"}, ids))
+        self.archives = archives
+        self.endpoints = {
+            "upload": self.upload,
+            "user_items": self.user_items,
+            "share_upload": self.share_upload,
+            "user_info": self.user_info,
+            "user_history": self.user_history,
+        }
+
+    def upload(self, client, headers, ids):
+        archive = random.choice(self.archives)
+        return client.post(
+            "/file/upload",
+            params={"file_type": "file"},
+            files={"file": ("archive.zip", archive, "application/zip")},
+            headers=headers,
+        )
+
+    def user_items(self, client, headers, ids):
+        return client.get("/file/user_items", headers=headers)
+
+    def share_upload(self, client, headers, ids):
+        return client.post(
+            "/file/share-upload",
+            json={
+                "upload_id": random.choice(ids),
+                "recipient_email": f"recipient{random.randrange(1000)}@example.com",
+                "description": "Load benchmark",
+            },
+            headers=headers,
+        )
+
+    def user_info(self, client, headers, ids):
+        return client.get("/user/info", headers=headers)
+
+    def user_history(self, client, headers, ids):
+        return client.get("/user/history", headers=headers)
+
+
+class Recorder:
+    """
+    Collects the latencies and errors of one phase, by endpoint.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.peak_rss = 0
+        self.elapsed = 0.0
+
+    def record(self, endpoint: str, latency: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self):
+        results = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies.sort()
+            if len(latencies) > 1:
+                cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+                p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+            else:
+                p50 = p95 = p99 = latencies[0]
+            results[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput": len(latencies) / self.elapsed,
+                "p50_ms": p50 * 1000,
+                "p95_ms": p95 * 1000,
+                "p99_ms": p99 * 1000,
+                "peak_rss_mb": self.peak_rss / 2**20,
+            }
+        return results
+
+
+async def run_phase(client, workload: Workload, weights: dict, pid: int, duration: float, concurrency: int):
+    """
+    Sends requests from `concurrency` clients for `duration` seconds, picking endpoints by weight.
+    """
+    recorder = Recorder()
+    endpoints = list(weights)
+    chances = list(weights.values())
+    deadline = time.perf_counter() + duration
+
+    async def client_loop():
+        while time.perf_counter() < deadline:
+            endpoint = random.choices(endpoints, chances)[0]
+            headers, ids = random.choice(workload.users)
+            started = time.perf_counter()
+            try:
+                response = await workload.endpoints[endpoint](client, headers, ids)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            recorder.record(endpoint, time.perf_counter() - started, ok)
+
+    async def sample_rss():
+        while True:
+            recorder.peak_rss = max(recorder.peak_rss, rss_bytes(pid))
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.ensure_future(sample_rss())
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    recorder.elapsed = time.perf_counter() - started
+    sampler.cancel()
+    recorder.peak_rss = max(recorder.peak_rss, rss_bytes(pid))
+    return recorder.summary()
+
+
+async def run_benchmark(args, upload_ids, workdir: str):
+    sink = SmtpSink()
+    smtp_server = await asyncio.start_server(sink.handle, "127.0.0.1", 0)
+    smtp_port = smtp_server.sockets[0].getsockname()[1]
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "api_app.main:app",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--no-access-log", "--log-level", "warning",
+        ],
+        cwd=workdir,
+        env=server_environment(args.database, smtp_port, workdir),
+    )
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60
+        ) as client:
+            await wait_for_server(client, server)
+            workload = Workload(upload_ids, make_archives(32, args.upload_kb * 1024))
+
+            phases = {endpoint: {endpoint: 1} for endpoint in workload.endpoints}
+            phases["mixed"] = MIXED_WEIGHTS
+            results = {}
+            for phase, weights in phases.items():
+                # A short warm-up fills the pool and caches before measuring
+                await run_phase(client, workload, weights, server.pid, min(1.0, args.duration), args.concurrency)
+                results[phase] = await run_phase(
+                    client, workload, weights, server.pid, args.duration, args.concurrency
+                )
+                print_phase(phase, results[phase])
+            return results
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        await sink.close_connections()
+        smtp_server.close()
+        await smtp_server.wait_closed()
+        print(f"{sink.messages} share emails delivered to the SMTP sink")
+
+
+def print_phase(phase: str, results: dict):
+    for endpoint, measured in sorted(results.items()):
+        print(
+            f"{phase:<13} {endpoint:<13} {measured['requests']:>7} {measured['errors']:>6} "
+            f"{measured['throughput']:>9.1f} {measured['p50_ms']:>8.1f} {measured['p95_ms']:>8.1f} "
+            f"{measured['p99_ms']:>8.1f} {measured['peak_rss_mb']:>8.1f}"
+        )
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Returns a description of every measurement that regressed beyond `tolerance`.
+    """
+    regressions = []
+    for phase, endpoints in baseline.items():
+        for endpoint, expected in endpoints.items():
+            measured = results.get(phase, {}).get(endpoint)
+            if measured is None:
+                continue
+            name = f"{phase}/{endpoint}"
+            if measured["throughput"] < expected["throughput"] * (1 - tolerance):
+                regressions.append(
+                    f"{name}: throughput {measured['throughput']:.1f} req/s, baseline {expected['throughput']:.1f}"
+                )
+            if measured["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{name}: p95 {measured['p95_ms']:.1f} ms, baseline {expected['p95_ms']:.1f}")
+            if measured["peak_rss_mb"] > expected["peak_rss_mb"] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: peak RSS {measured['peak_rss_mb']:.1f} MB, baseline {expected['peak_rss_mb']:.1f}"
+                )
+            if measured["errors"] > expected["errors"]:
+                regressions.append(f"{name}: {measured['errors']} errors, baseline {expected['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--duration", type=float, default=10, help="seconds each phase runs")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--uploads-per-user", type=int, default=200)
+    parser.add_argument("--history-per-user", type=int, default=20)
+    parser.add_argument("--upload-kb", type=int, default=256, help="size of the uploaded archives")
+    parser.add_argument("--database", default="xendpal_load_benchmark", help="throwaway database to create")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, as a fraction")
+    args = parser.parse_args()
+
+    url = create_database(args.database)
+    try:
+        upload_ids = seed(url, args.users, args.uploads_per_user, args.history_per_user)
+        print(
+            f"{'phase':<13} {'endpoint':<13} {'requests':>7} {'errors':>6} "
+            f"{'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MB':>8}"
+        )
+        with tempfile.TemporaryDirectory() as workdir:
+            os.makedirs(os.path.join(workdir, "Uploads"))
+            results = asyncio.run(run_benchmark(args, upload_ids, workdir))
+    finally:
+        drop_database(args.database)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, run with --save-baseline to record one")
+        return
+
+    regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+    for regression in regressions:
+        print(f"  regression: {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
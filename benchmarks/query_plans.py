@@ -0,0 +1,172 @@
+"""
+Checks that the queries issued by the routers are served by indexes.
+
+The script creates the tables in a throwaway schema of the configured database,
+seeds it with a realistic dataset, runs ``EXPLAIN`` on every router query and
+exits with a non-zero status if any of them falls back to a sequential scan.
+The schema is dropped afterwards, so the real tables are never touched.
+
+Usage::
+
+    python -m benchmarks.query_plans [--users 1000] [--uploads-per-user 50]
+"""
+import argparse
+import random
+import sys
+import uuid
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, select, text
+
+from api_app import models
+from api_app.database import get_engine
+from api_app.storage import delete_recipients_statement
+from api_app.routers.files import user_items_statement
+from api_app.routers.users import user_history_statement
+from api_app.usage import monthly_usage_statement, usage_statement, yearly_usage_statement
+
+SCHEMA = "query_plan_check"
+
+
+def seed(connection, users: int, uploads_per_user: int):
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    emails = [f"user{i}@example.com" for i in range(users)]
+
+    connection.execute(
+        models.User.__table__.insert(),
+        [
+            {"email": email, "sub": str(i), "name": email, "space": 0, "max_space": 2**31}
+            for i, email in enumerate(emails)
+        ],
+    )
+
+    uploads, blobs, shares, recipients, history = [], [], [], [], []
+    for email in emails:
+        for _ in range(uploads_per_user):
+            upload_id = str(uuid.uuid4())
+            created_at = now - timedelta(minutes=rng.randrange(60 * 24 * 400))
+            digest = uuid.uuid4().hex * 2
+            size = rng.randrange(1, 2**24)
+            blobs.append({
+                "digest": digest,
+                "path": f"Uploads/blobs/{digest}",
+                "size": size,
+                "ref_count": 1,
+            })
+            uploads.append({
+                "id": upload_id,
+                "name": "archive.zip",
+                "path": f"Uploads/blobs/{digest}",
+                "type": rng.choice(["file", "folder"]),
+                "created_at": created_at,
+                "size": size,
+                "owner_id": email,
+                "blob_digest": digest,
+            })
+            history.append({
+                "id": str(uuid.uuid4()),
+                "created_at": created_at,
+                "message": "shared",
+                "user_email": email,
+            })
+            if rng.random() < 0.3:
+                shared_upload_id = str(uuid.uuid4())
+                shares.append({"id": shared_upload_id, "upload_id": upload_id, "time_shared": created_at})
+                recipients.append({
+                    "id": str(uuid.uuid4()),
+                    "shared_upload_id": shared_upload_id,
+                    "recipient_email": rng.choice(emails),
+                    "upload_id": upload_id,
+                })
+
+    connection.execute(models.Blob.__table__.insert(), blobs)
+    connection.execute(models.Upload.__table__.insert(), uploads)
+    connection.execute(models.SharedUpload.__table__.insert(), shares)
+    connection.execute(models.SharedRecipient.__table__.insert(), recipients)
+    connection.execute(models.History.__table__.insert(), history)
+    connection.execute(text(
+        "INSERT INTO daily_usage (user_email, day, size, uploads) "
+        "SELECT owner_id, created_at::date, sum(size), count(*) FROM uploads GROUP BY 1, 2"
+    ))
+    connection.execute(text("ANALYZE"))
+    return emails, uploads
+
+
+def router_queries(email: str, upload: dict):
+    cursor = (upload["created_at"], upload["id"])
+    return {
+        "get_current_user": select(models.User).where(models.User.email == email),
+        "login_callback": select(models.User).where(models.User.sub == "7"),
+        "demo_account_login": select(models.User).where(
+            models.User.sub == "7", models.User.email == email
+        ),
+        "user_items (first page)": user_items_statement(email, 51),
+        "user_items (next page)": user_items_statement(email, 51, cursor),
+        "user_items (by type)": user_items_statement(email, 51, None, "file"),
+        "get upload by id": select(models.Upload).where(models.Upload.id == upload["id"]),
+        "uploads by blob": select(models.Upload).where(
+            models.Upload.blob_digest == "0" * 64
+        ),
+        "shares of an upload": select(models.SharedUpload).where(
+            models.SharedUpload.upload_id == upload["id"]
+        ),
+        "user_history": user_history_statement(email, date.today()),
+        "get_yearly_usage": yearly_usage_statement(email),
+        "get_monthly_usage": monthly_usage_statement(email),
+        "usage by week": usage_statement(
+            email, "week", date.today() - timedelta(days=365), date.today()
+        ),
+        "delete blob": delete(models.Blob).where(models.Blob.digest == "0" * 64),
+        "delete upload recipients": delete_recipients_statement(upload["id"]),
+    }
+
+
+def sequential_scans(plan):
+    """
+    Yields the relations read with a sequential scan anywhere in a JSON plan.
+    """
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from sequential_scans(child)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--uploads-per-user", type=int, default=50)
+    args = parser.parse_args()
+
+    failures = []
+    engine = get_engine()
+    with engine.connect() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        connection.execute(text(f"SET search_path TO {SCHEMA}"))
+        try:
+            models.Base.metadata.create_all(connection)
+            emails, uploads = seed(connection, args.users, args.uploads_per_user)
+
+            for name, statement in router_queries(emails[7], uploads[len(uploads) // 2]).items():
+                compiled = statement.compile(dialect=engine.dialect)
+                plan = connection.exec_driver_sql(
+                    f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params
+                ).scalar()[0]["Plan"]
+                scanned = sorted(set(sequential_scans(plan)))
+                status = f"seq scan on {', '.join(scanned)}" if scanned else "ok"
+                print(f"{name:<28} {status}")
+                if scanned:
+                    failures.append(name)
+        finally:
+            connection.rollback()
+            connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            connection.commit()
+
+    if failures:
+        print(f"\n{len(failures)} queries fall back to sequential scans")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Checks the rate limits against the in-memory store and Redis.
+
+The rate limit middleware is driven directly, in front of an app that answers every
+request with 200, so no database or server is needed. For each store the script
+checks that requests are counted per window, that the request over a limit gets 429
+with a ``Retry-After`` header pointing at the end of the window, that the per-user
+and per-IP limits count separately, and that a new window starts from zero. The Redis
+store runs against ``--redis-url`` or, without one, against an in-process fakeredis
+server standing in for Redis. Finally a Redis store pointing at a closed port must let
+every request through. The script exits with a non-zero status if a check fails.
+
+Usage::
+
+    python -m benchmarks.rate_limits [--redis-url URL] [--window 2]
+"""
+import argparse
+import asyncio
+import logging
+import socket
+import sys
+import threading
+import time
+
+from api_app import Oauth2
+from api_app.cache import MemoryStore, RedisStore
+from api_app.config import settings
+from api_app.ratelimit import RateLimitMiddleware
+
+UPLOAD = ("POST", "/file/upload")
+LOGIN = ("POST", "/user/login/demo")
+
+
+async def ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def bearer(email: str) -> str:
+    return Oauth2.create_access_token({"user_email": email}, give=False)
+
+
+async def request(middleware, route, ip: str, token: str = None):
+    """
+    Sends one request through the middleware.
+
+    Returns:
+        tuple: The status and the `Retry-After` header in seconds, or None without one.
+    """
+    method, path = route
+    headers = [(b"authorization", f"Bearer {token}".encode())] if token else []
+    scope = {"type": "http", "method": method, "path": path, "headers": headers, "client": (ip, 50000)}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware(scope, receive, send)
+    start = sent[0]
+    retry_after = dict(start["headers"]).get(b"retry-after")
+    return start["status"], int(retry_after) if retry_after else None
+
+
+async def wait_for_next_window(window: int):
+    await asyncio.sleep(window - time.time() % window + 0.05)
+
+
+async def check_store(store, window: int):
+    middleware = RateLimitMiddleware(ok_app, store)
+    alice, bob, carol = (bearer(f"{name}@example.com") for name in ("alice", "bob", "carol"))
+
+    # Start at the beginning of a window so the checks below fit in it
+    await wait_for_next_window(window)
+
+    # Per user: alice uses up her uploads, bob can still upload from another IP
+    statuses = [(await request(middleware, UPLOAD, "10.0.0.1", alice))[0] for _ in range(3)]
+    assert statuses == [200, 200, 200], f"uploads within the limit got {statuses}"
+    status, retry_after = await request(middleware, UPLOAD, "10.0.0.1", alice)
+    assert status == 429, f"the upload over the per-user limit got {status}"
+    assert retry_after is not None and 1 <= retry_after <= window, f"Retry-After was {retry_after}"
+    status, _ = await request(middleware, UPLOAD, "10.0.0.2", bob)
+    assert status == 200, f"another user's upload got {status}"
+
+    # Per IP: carol shares alice's address, which has two uploads left out of five
+    statuses = [(await request(middleware, UPLOAD, "10.0.0.1", carol))[0] for _ in range(3)]
+    assert statuses == [200, 200, 429], f"uploads from an IP near its limit got {statuses}"
+
+    # Per IP: logins are counted per client address, whoever sends them
+    statuses = [(await request(middleware, LOGIN, "10.0.0.3"))[0] for _ in range(2)]
+    assert statuses == [200, 200], f"logins within the limit got {statuses}"
+    status, retry_after = await request(middleware, LOGIN, "10.0.0.3", bob)
+    assert status == 429 and retry_after, f"the login over the per-IP limit got {status}"
+    status, _ = await request(middleware, LOGIN, "10.0.0.4")
+    assert status == 200, f"a login from another IP got {status}"
+
+    # Routes without a limit are never counted
+    status, _ = await request(middleware, ("GET", "/file/user_items"), "10.0.0.1", alice)
+    assert status == 200, f"an unlimited route got {status}"
+
+    # The counts start over with the next window
+    await wait_for_next_window(window)
+    status, _ = await request(middleware, UPLOAD, "10.0.0.1", alice)
+    assert status == 200, f"the first upload of a new window got {status}"
+    status, _ = await request(middleware, LOGIN, "10.0.0.3")
+    assert status == 200, f"the first login of a new window got {status}"
+
+
+async def check_fail_open(store):
+    middleware = RateLimitMiddleware(ok_app, store)
+    token = bearer("alice@example.com")
+    statuses = {(await request(middleware, UPLOAD, "10.0.0.1", token))[0] for _ in range(10)}
+    assert statuses == {200}, f"requests got {statuses} while Redis was down"
+    assert store.errors, "the failed Redis calls were not counted"
+
+
+def closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stand_in():
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f"redis://{host}:{port}/0"
+
+
+async def run_checks(redis_url: str, window: int):
+    stores = {
+        "memory": MemoryStore(1000),
+        f"redis ({redis_url})": RedisStore(redis_url, prefix=f"rate-limit-check:{time.time()}:"),
+    }
+    checks = [(name, check_store(store, window)) for name, store in stores.items()]
+    down = RedisStore(f"redis://127.0.0.1:{closed_port()}/0")
+    checks.append(("redis down (fails open)", check_fail_open(down)))
+
+    failures = 0
+    for name, check in checks:
+        try:
+            await check
+        except AssertionError as e:
+            failures += 1
+            print(f"{name:<40} FAILED {e}")
+            continue
+        print(f"{name:<40} ok")
+
+    for store in (*stores.values(), down):
+        await store.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--redis-url", help="Redis server to check against; a fakeredis server is started if omitted")
+    parser.add_argument("--window", type=int, default=2, help="seconds the limits are counted over")
+    args = parser.parse_args()
+
+    # The failed calls to the Redis store that is down are expected
+    logging.getLogger("api_app.cache").setLevel(logging.ERROR)
+    settings.RATE_LIMIT_WINDOW = args.window
+    settings.RATE_LIMIT_UPLOADS_PER_USER = 3
+    settings.RATE_LIMIT_UPLOADS_PER_IP = 5
+    settings.RATE_LIMIT_LOGINS_PER_IP = 2
+
+    stand_in = None
+    redis_url = args.redis_url
+    if not redis_url:
+        stand_in, redis_url = start_stand_in()
+
+    try:
+        failures = asyncio.run(run_checks(redis_url, args.window))
+    finally:
+        if stand_in:
+            stand_in.shutdown()
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
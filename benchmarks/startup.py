@@ -0,0 +1,139 @@
+"""
+Measures how long a new worker takes to start and checks it against a time budget.
+
+Two things are timed, each in fresh processes so nothing is already imported or
+cached: importing ``api_app.main``, and booting it under uvicorn until it answers
+its first request. The import probe also checks that the modules the api defers to
+first use (premailer, jinja2, werkzeug, httpx, smtplib and the database drivers)
+are not loaded at import. The script exits with a non-zero status if the median of
+either timing exceeds its budget or a deferred module was imported, so it can run
+as a check in CI.
+
+No database is needed: the engine is created in the lifespan but only connects when
+a request uses it, and the first request goes to ``/metrics``.
+
+Usage::
+
+    python -m benchmarks.startup [--runs 5] [--import-budget 1.0] [--first-request-budget 2.0]
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+INTERNAL_TOKEN = "startup-benchmark"
+
+DEFERRED_MODULES = ("premailer", "jinja2", "werkzeug", "httpx", "smtplib", "asyncpg", "psycopg2")
+
+IMPORT_PROBE = f"""
+import json, sys, time
+started = time.perf_counter()
+import api_app.main
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    "seconds": elapsed,
+    "loaded": [name for name in {DEFERRED_MODULES!r} if name in sys.modules],
+}}))
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(REPO_ROOT), env.get("PYTHONPATH")]))
+    env["INTERNAL_TOKEN"] = INTERNAL_TOKEN
+    return env
+
+
+def measure_import(workdir: str):
+    probe = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE],
+        cwd=workdir, env=environment(), capture_output=True, text=True, check=True,
+    )
+    return json.loads(probe.stdout.splitlines()[-1])
+
+
+def first_response(port: int) -> bool:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        connection.request("GET", "/metrics", headers={"Authorization": f"Bearer {INTERNAL_TOKEN}"})
+        return connection.getresponse().status == 200
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def measure_first_request(workdir: str, timeout: float = 30) -> float:
+    """
+    Starts uvicorn and returns the seconds until it has answered its first request.
+    """
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api_app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=environment(),
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"The server exited with status {server.returncode}")
+            if first_response(port):
+                return time.perf_counter() - started
+            time.sleep(0.01)
+        raise RuntimeError("The server did not start in time")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--runs", type=int, default=5, help="processes started for each timing")
+    parser.add_argument("--import-budget", type=float, default=1.0,
+                        help="seconds the median import of api_app.main may take")
+    parser.add_argument("--first-request-budget", type=float, default=2.0,
+                        help="seconds the median time from starting uvicorn to the first response may take")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        probes = [measure_import(workdir) for _ in range(args.runs)]
+        first_requests = [measure_first_request(workdir) for _ in range(args.runs)]
+
+    import_time = statistics.median(probe["seconds"] for probe in probes)
+    first_request_time = statistics.median(first_requests)
+    loaded = sorted({name for probe in probes for name in probe["loaded"]})
+
+    failures = []
+    for name, measured, budget in (
+        ("import api_app.main", import_time, args.import_budget),
+        ("first request", first_request_time, args.first_request_budget),
+    ):
+        status = "ok" if measured <= budget else "OVER BUDGET"
+        print(f"{name:<22} {measured * 1000:8.1f} ms  (budget {budget * 1000:.0f} ms)  {status}")
+        if measured > budget:
+            failures.append(name)
+    if loaded:
+        print(f"{'deferred modules':<22} imported at startup: {', '.join(loaded)}")
+        failures.append("deferred modules")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
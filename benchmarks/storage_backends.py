@@ -0,0 +1,136 @@
+"""
+Checks the storage backends against each other and measures their throughput.
+
+Every backend goes through the same checks: storing a file, reading it whole,
+by range and from a seeked position, listing the ZIP central directory through
+it, listing keys and deleting. The local backend uses a temporary directory.
+The S3 backend runs against ``--endpoint-url`` (e.g. a MinIO container) or,
+without one, against an in-process moto server standing in for S3.
+
+Usage::
+
+    python -m benchmarks.storage_backends [--size-mb 64] [--endpoint-url URL] [--bucket NAME]
+"""
+import argparse
+import hashlib
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+from api_app.archives import read_zip_index
+from api_app.backends import LocalBackend, S3Backend
+
+
+def make_archive(path: Path, size: int):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("small.txt", b"hello")
+        with archive.open("large.bin", "w", force_zip64=True) as member:
+            remaining = size
+            while remaining > 0:
+                chunk = os.urandom(min(remaining, 1024 * 1024))
+                member.write(chunk)
+                remaining -= len(chunk)
+
+
+def check_backend(backend, workdir: Path, size: int):
+    source = workdir / "source.zip"
+    make_archive(source, size)
+    content = source.read_bytes()
+    key = hashlib.sha256(content).hexdigest()
+    staged = workdir / "staged.zip"
+    staged.write_bytes(content)
+
+    results = {}
+    started = time.perf_counter()
+    backend.put_file(staged, key)
+    results["put MB/s"] = len(content) / (time.perf_counter() - started) / 2**20
+
+    assert not staged.exists(), "put_file must consume the staged file"
+    assert backend.exists(key) and not backend.exists("0" * 64)
+    assert backend.size(key) == len(content)
+
+    started = time.perf_counter()
+    read = b"".join(backend.iter_range(key, 0, len(content) - 1))
+    results["read MB/s"] = len(content) / (time.perf_counter() - started) / 2**20
+    assert read == content
+
+    assert b"".join(backend.iter_range(key, 10, 99)) == content[10:100]
+    with backend.open(key) as opened:
+        opened.seek(-22, io.SEEK_END)
+        assert opened.read() == content[-22:]
+
+    started = time.perf_counter()
+    with backend.open(key) as opened:
+        index = read_zip_index(opened)
+    results["index ms"] = (time.perf_counter() - started) * 1000
+    assert [entry.name for entry in index.entries] == ["small.txt", "large.bin"]
+
+    assert key in {listed for listed, _ in backend.iter_keys()}
+    backend.delete(key)
+    backend.delete(key)
+    assert not backend.exists(key)
+    return results
+
+
+def start_stand_in():
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--size-mb", type=int, default=64, help="size of the test archive")
+    parser.add_argument("--endpoint-url", help="S3-compatible endpoint; a moto server is started if omitted")
+    parser.add_argument("--bucket", default="xendpal-backend-check")
+    args = parser.parse_args()
+
+    stand_in = None
+    endpoint_url = args.endpoint_url
+    if not endpoint_url:
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        stand_in, endpoint_url = start_stand_in()
+
+    failures = 0
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            workdir = Path(workdir)
+            s3 = S3Backend(args.bucket, prefix="check/", endpoint_url=endpoint_url, region_name="us-east-1")
+            try:
+                s3.client.create_bucket(Bucket=args.bucket)
+            except s3.client.exceptions.BucketAlreadyOwnedByYou:
+                pass
+
+            backends = {
+                "local": LocalBackend(workdir / "blobs"),
+                f"s3 ({endpoint_url})": s3,
+            }
+            for name, backend in backends.items():
+                try:
+                    results = check_backend(backend, workdir, args.size_mb * 2**20)
+                except AssertionError as e:
+                    failures += 1
+                    print(f"{name:<36} FAILED {e}")
+                    continue
+                measured = "  ".join(f"{metric} {value:8.1f}" for metric, value in results.items())
+                print(f"{name:<36} ok  {measured}")
+    finally:
+        if stand_in:
+            stand_in.stop()
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()